@@ -2,27 +2,34 @@
 ## This file contains the FastAPI Application ##
 ################################################
 import os
-import openai
-import spotipy
+import asyncio
+import logging
+import logging.handlers
+import queue
 from spotipy.oauth2 import SpotifyOAuth
 from fastapi import FastAPI, Request, Query
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from dotenv import load_dotenv
-import json
-import re
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+import orjson
+from contextlib import asynccontextmanager
 from typing import List
 from music_utils import (
     get_user_preferences,
-    get_song_metadata,
     interpret_user_query,
     generate_constrained_playlist,
-    cache_labeled_liked_songs
+    iter_constrained_playlist,
+    cache_labeled_liked_songs,
+    get_spotify_client,
+    get_http_session,
+    close_http_session,
+    flush_artist_genres_index
 )
 
 load_dotenv()
 
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-
 sp_oauth = SpotifyOAuth(
     client_id=os.environ.get("SPOTIPY_CLIENT_ID"),
     client_secret=os.environ.get("SPOTIPY_CLIENT_SECRET"),
@@ -30,7 +37,39 @@ sp_oauth = SpotifyOAuth(
     scope="user-top-read user-library-read playlist-modify-public"
 )
 
-app = FastAPI()
+def start_log_listener():
+    """
+    Route music_utils logging through a queue so handlers write to stderr off the request path.
+    The level comes from LOG_LEVEL (default WARNING, which keeps debug output off).
+    """
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(), respect_handler_level=True)
+    app_logger = logging.getLogger("music_utils")
+    app_logger.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener = start_log_listener()
+    await get_http_session()
+    yield
+    await flush_artist_genres_index()
+    await close_http_session()
+    log_listener.stop()
+
+def rate_limit_key(request: Request):
+    return request.query_params.get("access_token") or get_remote_address(request)
+
+# Counters live in RATE_LIMIT_STORAGE_URI (e.g. redis://host:6379) so all workers share them; the
+# in-memory default is per worker, which multiplies PLAYLIST_RATE_LIMIT by the worker count.
+limiter = Limiter(key_func=rate_limit_key, storage_uri=os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://"))
+PLAYLIST_RATE_LIMIT = os.environ.get("PLAYLIST_RATE_LIMIT", "10/minute")
+
+app = FastAPI(lifespan=lifespan)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 @app.get("/")
 def home():
@@ -42,40 +81,70 @@ def login():
     return RedirectResponse(auth_url)
 
 @app.get("/callback")
-def callback(request: Request):
+async def callback(request: Request):
     code = request.query_params.get("code")
-    token_info = sp_oauth.get_access_token(code)
+    token_info = await asyncio.to_thread(sp_oauth.get_access_token, code)
     return {"access_token": token_info["access_token"], "refresh_token": token_info["refresh_token"]}
 
 @app.get("/get_user_data")
-def get_user_data(access_token: str = Query(..., description="User's Spotify access token")):
-    return get_user_preferences(access_token)
+async def get_user_data(access_token: str = Query(..., description="User's Spotify access token")):
+    return await get_user_preferences(access_token)
 
 @app.get("/generate_playlist")
-def generate_personalized_playlist(
+@limiter.limit(PLAYLIST_RATE_LIMIT)
+async def generate_personalized_playlist(
+    request: Request,
     user_query: str = Query(..., description="Describe your playlist request"),
     access_token: str = Query(..., description="User's Spotify access token"),
-    debug: bool = Query(False, description="Enable debug mode to show chain-of-thought reasoning")
+    debug: bool = Query(False, description="Enable debug mode to show chain-of-thought reasoning"),
+    refresh: bool = Query(False, description="Generate fresh AI suggestions instead of reusing cached ones"),
+    explain: bool = Query(False, description="Add a model-written explanation for each song")
 ):
-    result = generate_constrained_playlist(user_query, access_token=access_token, debug=debug)
+    result = await generate_constrained_playlist(
+        user_query, access_token=access_token, debug=debug, refresh=refresh, explain=explain
+    )
     return result
 
+def create_spotify_playlist(access_token, playlist_name, track_uris):
+    sp = get_spotify_client(access_token)
+    user_id = sp.me()["id"]
+    playlist = sp.user_playlist_create(user_id, playlist_name, public=True)
+    sp.playlist_add_items(playlist["id"], track_uris)
+    return playlist
+
+@app.get("/generate_playlist_stream")
+@limiter.limit(PLAYLIST_RATE_LIMIT)
+async def stream_personalized_playlist(
+    request: Request,
+    user_query: str = Query(..., description="Describe your playlist request"),
+    access_token: str = Query(..., description="User's Spotify access token"),
+    refresh: bool = Query(False, description="Generate fresh AI suggestions instead of reusing cached ones")
+):
+    """
+    Stream playlist entries as newline-delimited JSON, one line per song as soon as it is ready.
+    """
+    constraints = await interpret_user_query(user_query)
+    constraints["user_query"] = user_query
+
+    async def playlist_lines():
+        async for song in iter_constrained_playlist(constraints, access_token=access_token, refresh=refresh):
+            yield orjson.dumps(song) + b"\n"
+
+    return StreamingResponse(playlist_lines(), media_type="application/x-ndjson")
+
 @app.get("/save_playlist")
-def save_playlist(
+async def save_playlist(
     playlist_name: str, 
     track_uris: List[str] = Query(...),
     access_token: str = Query(..., description="User's Spotify access token")
 ):
-    sp = spotipy.Spotify(auth=access_token)
-    user_id = sp.me()["id"]
-    playlist = sp.user_playlist_create(user_id, playlist_name, public=True)
-    sp.playlist_add_items(playlist["id"], track_uris)
+    playlist = await asyncio.to_thread(create_spotify_playlist, access_token, playlist_name, track_uris)
     return {"message": f"Playlist '{playlist_name}' created!", "url": playlist["external_urls"]["spotify"]}
 
 @app.get("/cache_user_data")
-def cache_user_data(access_token: str = Query(..., description="User's Spotify access token"), debug: bool = Query(False)):
+async def cache_user_data(access_token: str = Query(..., description="User's Spotify access token"), debug: bool = Query(False)):
     """
     Pre-fetch and label all liked songs and cache the processed data.
     """
-    labeled_songs = cache_labeled_liked_songs(access_token, debug=debug)
+    labeled_songs = await cache_labeled_liked_songs(access_token, debug=debug)
     return {"cached_count": len(labeled_songs)}
@@ -3,20 +3,31 @@
 ##############################################################################
 import os
 import re
-import json
+import string
+import copy
+import logging
 import time
+import orjson
 import asyncio
+import hashlib
+import tempfile
+import functools
+import inspect
+import operator
 import aiohttp
 import requests
-import openai
+import requests.adapters
 import spotipy
+from urllib3.util.retry import Retry
 from spotipy.oauth2 import SpotifyOAuth
 from urllib.parse import quote
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 sp_oauth = SpotifyOAuth(
     client_id=os.environ.get("SPOTIPY_CLIENT_ID"),
     client_secret=os.environ.get("SPOTIPY_CLIENT_SECRET"),
@@ -24,362 +35,1191 @@ sp_oauth = SpotifyOAuth(
     scope="user-top-read user-library-read"
 )
 
+# One pooled session shared by every spotipy client so keep-alive connections are reused.
+# The pool is sized for the default asyncio.to_thread worker count, so concurrent playlist saves
+# reuse connections instead of overflowing urllib3's default pool of 10.
+# spotipy only installs its retry adapter on sessions it builds itself, so the same policy is mounted here.
+# Retry-After is not honoured: Spotify can ask for minutes, which would stall the saving thread; the
+# short backoff is used instead, and a 429 that outlasts it is returned to the caller.
+SPOTIFY_POOL_SIZE = 32
+SPOTIFY_RETRY = Retry(
+    total=3,
+    connect=None,
+    read=False,
+    status=3,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    raise_on_status=False,
+    respect_retry_after_header=False
+)
+SPOTIFY_SESSION = requests.Session()
+SPOTIFY_SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=SPOTIFY_POOL_SIZE,
+    pool_maxsize=SPOTIFY_POOL_SIZE,
+    max_retries=SPOTIFY_RETRY
+))
+
+@functools.lru_cache(maxsize=1024)
+def get_spotify_client(access_token=None):
+    """
+    Return a spotipy client for the given user token, or the app-level client when no token is given.
+    Clients are created on first use, memoized per token, and all share SPOTIFY_SESSION.
+    """
+    if access_token:
+        return spotipy.Spotify(auth=access_token, requests_session=SPOTIFY_SESSION)
+    return spotipy.Spotify(auth_manager=sp_oauth, requests_session=SPOTIFY_SESSION)
+
 ENABLE_SONG_EXPLANATION = False  # Set to True for extra explanation per song.
+ENABLE_COVER_PRELOAD = False  # Set to True to warm album-cover CDN caches while the playlist is built.
+GRADUAL_BPM_POOL_FACTOR = 3  # Candidates per playlist slot considered when sorting a gradual BPM playlist.
+
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+SPOTIFY_MAX_CONCURRENT_REQUESTS = 5
+SPOTIFY_PAGE_LIMIT = 50  # Largest page Spotify serves in a single request.
+SPOTIFY_RATE_LIMIT = float(os.environ.get("SPOTIFY_RATE_LIMIT", "10"))  # Requests per second across all users and workers.
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))  # Gunicorn worker count, set by start.sh.
+SPOTIFY_MAX_RETRIES = 3
+EXTERNAL_API_MAX_RETRIES = 2  # Last.fm and AcousticBrainz.
+EXTERNAL_API_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_AFTER = 5  # Longest Retry-After (seconds) worth waiting out inside a request.
+# Per-request bound for the shared aiohttp session, so a slow or hanging Spotify, Last.fm or
+# AcousticBrainz host fails fast instead of holding a playlist request for aiohttp's default 5 minutes.
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10, sock_connect=5)
+ACOUSTICBRAINZ_API_URL = "https://acousticbrainz.org/api/v1"
+ACOUSTICBRAINZ_MAX_CONCURRENT_REQUESTS = 10
+
+OPENAI_MAX_CONCURRENT_REQUESTS = 20
+# Constraint extraction is short, structured output, so it runs on a smaller, faster model than song generation.
+OPENAI_EXTRACT_MODEL = os.environ.get("OPENAI_EXTRACT_MODEL", "gpt-4o-mini")
+# Output caps: generation time grows with output length, so each call is bounded by what it should need.
+OPENAI_TOKENS_PER_SONG = 80  # One song object including its one-sentence reason.
+OPENAI_MAX_SONG_TOKENS = 4096
+OPENAI_CONSTRAINTS_MAX_TOKENS = 400
+
+def song_tokens_budget(song_count):
+    return min(OPENAI_MAX_SONG_TOKENS, OPENAI_TOKENS_PER_SONG * song_count + 50)
+
+class LeakyBucket:
+    """
+    Space requests out to at most rate_per_sec, so a burst drains at a steady pace
+    instead of tripping Spotify's 429 back-off for every user at once.
+    """
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+# Each worker paces its own share, so together they stay within SPOTIFY_RATE_LIMIT.
+spotify_limiter = LeakyBucket(SPOTIFY_RATE_LIMIT / WEB_CONCURRENCY)
+_spotify_semaphore = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENT_REQUESTS)
+_openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENT_REQUESTS)
+_acousticbrainz_semaphore = asyncio.Semaphore(ACOUSTICBRAINZ_MAX_CONCURRENT_REQUESTS)
+
+_http_session = None
+_openai_client = None
+
+async def get_http_session():
+    """
+    Return the shared aiohttp session, creating it on first use.
+    The FastAPI lifespan opens it at startup and closes it at shutdown.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300)
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+def get_openai_client():
+    """
+    Return the shared AsyncOpenAI client, creating it on first use.
+    openai is imported here rather than at module top since it is slow to import and
+    only needed once a request actually calls the model.
+    """
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    return _openai_client
+
+async def resolve_access_token(access_token=None):
+    if access_token:
+        return access_token
+    return await asyncio.to_thread(sp_oauth.get_access_token, as_dict=False)
+
+def retry_after_seconds(resp):
+    try:
+        return max(float(resp.headers.get("Retry-After", 1)), 0)
+    except ValueError:
+        return 1
+
+def retry_delay(resp, attempt, max_retries):
+    """
+    How long to wait before retrying a 429/5xx response: Retry-After when the server sent one,
+    otherwise a short exponential backoff. Returns None when the response should not be retried:
+    another status, retries used up, or a Retry-After longer than MAX_RETRY_AFTER seconds
+    (the caller then gives up rather than stall the request).
+    """
+    if resp.status not in EXTERNAL_API_RETRY_STATUSES or attempt >= max_retries:
+        return None
+    if "Retry-After" in resp.headers:
+        delay = retry_after_seconds(resp)
+        return delay if delay <= MAX_RETRY_AFTER else None
+    return 0.2 * 2 ** attempt
+
+async def spotify_get(access_token, path, params=None):
+    """
+    Issue a GET against the Spotify Web API using the shared session.
+    Requests are paced by spotify_limiter; a 429 or 5xx waits out Retry-After (or a short backoff) and is retried.
+    """
+    session = await get_http_session()
+    headers = {"Authorization": f"Bearer {access_token}"}
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        async with spotify_limiter, _spotify_semaphore:
+            async with session.get(f"{SPOTIFY_API_URL}/{path}", headers=headers, params=params) as resp:
+                delay = retry_delay(resp, attempt, SPOTIFY_MAX_RETRIES)
+                if delay is None:
+                    if resp.status == 401:
+                        forget_user_data(access_token)
+                    resp.raise_for_status()
+                    return orjson.loads(await resp.read())
+        await asyncio.sleep(delay)
 
 CACHE_DIR = "cache"
 if not os.path.exists(CACHE_DIR):
     os.makedirs(CACHE_DIR)
-LIKED_SONGS_CACHE_FILENAME = os.path.join(CACHE_DIR, "liked_songs_cache.json")
+# Per-user caches hold one file per token (see user_cache_filename).
+LIKED_SONGS_CACHE_DIR = os.path.join(CACHE_DIR, "liked_songs")
 LIKED_SONGS_CACHE_TTL = 43200  
-TOP_ARTISTS_CACHE_FILENAME = os.path.join(CACHE_DIR, "top_artists_cache.json")
+TOP_ARTISTS_CACHE_DIR = os.path.join(CACHE_DIR, "top_artists")
 TOP_ARTISTS_CACHE_TTL = 21600  
-TOP_TRACKS_CACHE_FILENAME = os.path.join(CACHE_DIR, "top_tracks_cache.json")
+TOP_TRACKS_CACHE_DIR = os.path.join(CACHE_DIR, "top_tracks")
 TOP_TRACKS_CACHE_TTL = 3600     
+LABELED_LIKED_SONGS_CACHE_DIR = os.path.join(CACHE_DIR, "labeled_liked_songs")
+LABELED_LIKED_SONGS_CACHE_TTL = 43200
+for user_cache_dir in (LIKED_SONGS_CACHE_DIR, TOP_ARTISTS_CACHE_DIR, TOP_TRACKS_CACHE_DIR, LABELED_LIKED_SONGS_CACHE_DIR):
+    os.makedirs(user_cache_dir, exist_ok=True)
+USER_PREFERENCES_CACHE_TTL = 3600
+USER_PREFERENCES_MEMORY_TTL = 300
+USER_PREFERENCES_MEMORY_MAXSIZE = 10000
+LIKED_INDEX_CACHE_DIR = os.path.join(CACHE_DIR, "liked_index")
+os.makedirs(LIKED_INDEX_CACHE_DIR, exist_ok=True)
+SONG_METADATA_CACHE_TTL = 604800  # AcousticBrainz data is effectively immutable.
+AI_SONGS_CACHE_TTL = 86400
+QUERY_CONSTRAINTS_CACHE_TTL = 86400
+LASTFM_CACHE_TTL = 43200
+ARTIST_GENRES_CACHE_TTL = 604800
+ARTIST_GENRES_INDEX_FILENAME = os.path.join(CACHE_DIR, "artist_genres_index.json")
+HTTP_VALIDATORS_CACHE_DIR = os.path.join(CACHE_DIR, "http_validators")
+os.makedirs(HTTP_VALIDATORS_CACHE_DIR, exist_ok=True)
+HTTP_VALIDATORS_CACHE_TTL = 2592000
+
+def cache_file_version(filename, ttl):
+    """
+    Return (mtime_ns, size) for a cache file young enough to be fresh, or None. The mtime is
+    written together with the embedded timestamp, so stale or missing files are rejected without
+    reading or decoding them.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if time.time() - st.st_mtime >= ttl or st.st_size == 0:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+@functools.lru_cache(maxsize=32)
+def read_cache_file(filename, version):
+    """
+    Decode a cache file, memoized per file version so repeat loads within the process skip the read.
+    An unreadable or undecodable file (e.g. removed mid-read) is treated as a miss and returns None.
+    """
+    try:
+        with open(filename, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
 
 def load_cache(filename, ttl):
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if time.time() - data.get("timestamp", 0) < ttl:
-                return data.get("items", None)
+    """
+    Return the cached items if the file is fresh. Items may be shared with other callers and must not be mutated.
+    """
+    version = cache_file_version(filename, ttl)
+    if version is not None:
+        data = read_cache_file(filename, version)
+        if isinstance(data, dict) and time.time() - data.get("timestamp", 0) < ttl:
+            return data.get("items", None)
     return None
 
 def save_cache(filename, items):
+    """
+    Write the cache file atomically: the data goes to a temp file next to it, which then replaces it,
+    so other workers reading the same file never see it empty or half-written.
+    """
     data = {"timestamp": time.time(), "items": items}
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+def cached(namespace, ttl, should_cache=None):
+    """
+    Cache a coroutine's JSON-serializable result on disk under CACHE_DIR/<namespace>,
+    keyed by a SHA-1 of its arguments (the 'debug' flag is not part of the key). A None result is never cached, so
+    functions return None for failures that should be retried; should_cache(result) can veto
+    storing other results. Calling with refresh=True skips the cached value and stores the fresh result.
+    """
+    cache_dir = os.path.join(CACHE_DIR, namespace)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    def decorator(func):
+        signature = inspect.signature(func)
 
-def load_liked_songs_cache():
-    return load_cache(LIKED_SONGS_CACHE_FILENAME, LIKED_SONGS_CACHE_TTL)
+        def cache_filename(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = "|".join(f"{name}={value!r}" for name, value in bound.arguments.items() if name != "debug")
+            return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
 
-def save_liked_songs_cache(items):
-    save_cache(LIKED_SONGS_CACHE_FILENAME, items)
+        @functools.wraps(func)
+        async def wrapper(*args, refresh=False, **kwargs):
+            filename = cache_filename(args, kwargs)
+            result = None if refresh else load_cache(filename, ttl)
+            if result is None:
+                result = await func(*args, **kwargs)
+                if result is not None and (should_cache is None or should_cache(result)):
+                    save_cache(filename, result)
+            return result
+        wrapper.cache_filename = cache_filename
+        return wrapper
+    return decorator
+
+def user_cache_filename(cache_dir, access_token):
+    return os.path.join(cache_dir, f"{token_key(access_token)}.json")
+
+def load_liked_songs_cache(access_token):
+    return load_cache(user_cache_filename(LIKED_SONGS_CACHE_DIR, access_token), LIKED_SONGS_CACHE_TTL)
+
+def save_liked_songs_cache(access_token, items):
+    save_cache(user_cache_filename(LIKED_SONGS_CACHE_DIR, access_token), items)
+
+def slim_liked_item(item):
+    """
+    Keep only the fields of a saved-track item that are read downstream (a few hundred bytes
+    instead of the full multi-KB Spotify object), preserving the original shape.
+    """
+    track = item["track"]
+    return {
+        "track": {
+            "id": track.get("id"),
+            "name": track["name"],
+            "artists": [{"id": artist.get("id"), "name": artist["name"]} for artist in track["artists"]],
+            "album": {"release_date": track.get("album", {}).get("release_date")}
+        }
+    }
 
 async def fetch_liked_songs_batch(session, access_token, offset, limit=50, debug=False):
-    url = "https://api.spotify.com/v1/me/tracks"
+    url = f"{SPOTIFY_API_URL}/me/tracks"
     headers = {"Authorization": f"Bearer {access_token}"}
     params = {"limit": limit, "offset": offset}
-    async with session.get(url, headers=headers, params=params) as resp:
-        if resp.status != 200:
-            if debug:
-                print(f"[DEBUG] Error fetching batch at offset {offset}: HTTP {resp.status}")
-            return None
-        data = await resp.json()
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        async with spotify_limiter, _spotify_semaphore:
+            async with session.get(url, headers=headers, params=params) as resp:
+                delay = retry_delay(resp, attempt, SPOTIFY_MAX_RETRIES)
+                if delay is None:
+                    if resp.status != 200:
+                        if debug:
+                            logger.debug("Error fetching batch at offset %s: HTTP %s", offset, resp.status)
+                        return None
+                    data = orjson.loads(await resp.read())
+                    data["items"] = [slim_liked_item(item) for item in data.get("items", [])]
+                    break
         if debug:
-            print(f"[DEBUG] Fetched {len(data.get('items', []))} songs at offset {offset}.")
-        return data
+            logger.debug("HTTP %s at offset %s; retrying in %ss.", resp.status, offset, delay)
+        await asyncio.sleep(delay)
+    if debug:
+        logger.debug("Fetched %s songs at offset %s.", len(data.get('items', [])), offset)
+    return data
+
+async def fetch_all_liked_song_pages(session, access_token, limit=50, debug=False):
+    """
+    Fetch the first page to learn the library size, then request every remaining page concurrently.
+    Concurrency is bounded by the Spotify semaphore and rate limiter inside fetch_liked_songs_batch.
+    Returns (items, complete); complete is False when any page failed.
+    """
+    first = await fetch_liked_songs_batch(session, access_token, 0, limit, debug)
+    if not first:
+        return [], False
+    items = list(first.get("items", []))
+    total = first.get("total", len(items))
+    pages = await asyncio.gather(
+        *(fetch_liked_songs_batch(session, access_token, offset, limit, debug) for offset in range(limit, total, limit)),
+        return_exceptions=True
+    )
+    complete = True
+    for page in pages:
+        if isinstance(page, Exception) or not page:
+            if debug:
+                logger.debug("Liked songs page failed: %s", page)
+            complete = False
+            continue
+        items.extend(page.get("items", []))
+    if debug:
+        logger.debug("Fetched %s of %s liked songs.", len(items), total)
+    return items, complete
 
 async def async_get_all_liked_songs(access_token, debug=False, min_matches=None, target_artist=None, genres=None):
-    cached = load_liked_songs_cache()
+    """
+    Return (items, complete). Only a library fetched without failed pages is cached;
+    otherwise whatever arrived is returned with complete=False.
+    """
+    cached = load_liked_songs_cache(access_token)
     if cached is not None:
         if debug:
-            print(f"[DEBUG] Loaded {len(cached)} liked songs from cache.")
-        return cached
+            logger.debug("Loaded %s liked songs from cache.", len(cached))
+        return cached, True
 
+    limit = SPOTIFY_PAGE_LIMIT
+    session = await get_http_session()
+    if not (target_artist or (genres and min_matches)):
+        items, complete = await fetch_all_liked_song_pages(session, access_token, limit, debug)
+        if complete:
+            save_liked_songs_cache(access_token, items)
+        return items, complete
+
+    # Filtered requests walk the pages in order so they can stop as soon as enough songs are found.
     items = []
-    limit = 50
     offset = 0
-    async with aiohttp.ClientSession() as session:
-        while True:
-            data = await fetch_liked_songs_batch(session, access_token, offset, limit, debug)
-            if not data:
+    while True:
+        data = await fetch_liked_songs_batch(session, access_token, offset, limit, debug)
+        if not data:
+            return items, False
+        batch = data.get("items", [])
+        items.extend(batch)
+        if debug:
+            logger.debug("Total songs so far: %s", len(items))
+        if target_artist:
+            count_artist = sum(
+                1 for track in batch if target_artist.lower() in track["track"]["artists"][0]["name"].lower()
+            )
+            if count_artist > 0 and len(items) >= 100:
+                if debug:
+                    logger.debug("Found enough songs for target artist '%s'.", target_artist)
                 break
-            batch = data.get("items", [])
-            items.extend(batch)
-            if debug:
-                print(f"[DEBUG] Total songs so far: {len(items)}")
-            if target_artist:
-                count_artist = sum(
-                    1 for track in batch if target_artist.lower() in track["track"]["artists"][0]["name"].lower()
-                )
-                if count_artist > 0 and len(items) >= 100:
-                    if debug:
-                        print(f"[DEBUG] Found enough songs for target artist '{target_artist}'.")
-                    break
-            elif genres and min_matches:
-                with ThreadPoolExecutor() as executor:
-                    futures = [
-                        executor.submit(
-                            song_matches_genre,
-                            {"name": track["track"]["name"], "artist": track["track"]["artists"][0]["name"]},
-                            genres
-                        )
-                        for track in batch
-                    ]
-                    matches = sum(f.result() for f in futures)
-                if matches >= min_matches:
-                    if debug:
-                        print(f"[DEBUG] Reached minimum matching songs ({min_matches}) in current batch.")
-                    break
-            await asyncio.sleep(2)  
-            if data.get("next") is None:
+        elif genres and min_matches:
+            labeled = await label_tracks_with_genres(access_token, [item["track"] for item in batch], debug)
+            target_genres = [g.lower() for g in genres]
+            matches = sum(genres_overlap(target_genres, song["labeled_genres"]) for song in labeled)
+            if matches >= min_matches:
+                if debug:
+                    logger.debug("Reached minimum matching songs (%s) in current batch.", min_matches)
                 break
-            offset += limit
-    save_liked_songs_cache(items)
-    return items
+        if data.get("next") is None:
+            break
+        offset += limit
+    save_liked_songs_cache(access_token, items)
+    return items, True
+
+def load_top_artists_cache(access_token):
+    return load_cache(user_cache_filename(TOP_ARTISTS_CACHE_DIR, access_token), TOP_ARTISTS_CACHE_TTL)
+
+def save_top_artists_cache(access_token, items):
+    save_cache(user_cache_filename(TOP_ARTISTS_CACHE_DIR, access_token), items)
 
-def load_top_artists_cache():
-    return load_cache(TOP_ARTISTS_CACHE_FILENAME, TOP_ARTISTS_CACHE_TTL)
+def load_top_tracks_cache(access_token):
+    return load_cache(user_cache_filename(TOP_TRACKS_CACHE_DIR, access_token), TOP_TRACKS_CACHE_TTL)
+
+def save_top_tracks_cache(access_token, items):
+    save_cache(user_cache_filename(TOP_TRACKS_CACHE_DIR, access_token), items)
+
+# Artist genres are shared by every user, so lookups are remembered process-wide (by id and by searched name)
+# and persisted to ARTIST_GENRES_INDEX_FILENAME so a restarted worker does not look them all up again.
+_artist_genres_memory = {}
+_searched_genres_memory = {}
+_artist_genres_index_loaded = False
+
+ARTIST_GENRES_FLUSH_EVERY = 200  # New lookups gathered before the index file is rewritten.
+ARTIST_GENRES_INDEX_MAXSIZE = 10000  # Entries kept per field in the shared index file (one memo's worth).
+_artist_genres_unsaved = 0
+_artist_genres_flush_task = None
+
+def index_entries(memory):
+    """
+    Snapshot a genre memo as key -> [wall-clock expiry, genres], the form stored in the index file.
+    """
+    now, wall_now = time.monotonic(), time.time()
+    return {key: [wall_now + expires - now, value] for key, (expires, value) in memory.items() if expires > now}
 
-def save_top_artists_cache(items):
-    save_cache(TOP_ARTISTS_CACHE_FILENAME, items)
+def merge_index_entries(memory, entries):
+    """
+    Remember the unexpired index entries the memo does not already hold.
+    """
+    wall_now = time.time()
+    for key, entry in entries.items():
+        if not (isinstance(entry, list) and len(entry) == 2):
+            continue  # Written by an older version without per-entry expiry.
+        expires_at, genres = entry
+        if expires_at > wall_now and recall(memory, key) is None:
+            remember(memory, key, genres, expires_at - wall_now)
 
-def load_top_tracks_cache():
-    return load_cache(TOP_TRACKS_CACHE_FILENAME, TOP_TRACKS_CACHE_TTL)
+def load_artist_genres_index():
+    global _artist_genres_index_loaded
+    if _artist_genres_index_loaded:
+        return
+    _artist_genres_index_loaded = True
+    index = load_cache(ARTIST_GENRES_INDEX_FILENAME, ARTIST_GENRES_CACHE_TTL) or {}
+    merge_index_entries(_artist_genres_memory, index.get("ids", {}))
+    merge_index_entries(_searched_genres_memory, index.get("names", {}))
 
-def save_top_tracks_cache(items):
-    save_cache(TOP_TRACKS_CACHE_FILENAME, items)
+def write_artist_genres_index(ids, names):
+    """
+    Merge the given entries over the unexpired ones on disk (other workers share the file) and
+    rewrite it, keeping the ARTIST_GENRES_INDEX_MAXSIZE latest-expiring entries per field.
+    Runs in a worker thread; returns the merged index.
+    """
+    index = load_cache(ARTIST_GENRES_INDEX_FILENAME, ARTIST_GENRES_CACHE_TTL) or {}
+    wall_now = time.time()
+    merged = {}
+    for field, entries in (("ids", ids), ("names", names)):
+        combined = {
+            key: entry for key, entry in index.get(field, {}).items()
+            if isinstance(entry, list) and len(entry) == 2 and entry[0] > wall_now
+        }
+        combined.update(entries)
+        if len(combined) > ARTIST_GENRES_INDEX_MAXSIZE:
+            latest = sorted(combined.items(), key=lambda item: item[1][0], reverse=True)
+            combined = dict(latest[:ARTIST_GENRES_INDEX_MAXSIZE])
+        merged[field] = combined
+    save_cache(ARTIST_GENRES_INDEX_FILENAME, merged)
+    return merged
 
-def label_song_with_artist_info(song, debug=False):
+async def flush_artist_genres_index():
     """
-    Enrich a song (with 'name' and 'artist') by fetching additional artist metadata.
-    Adds a 'labeled_genres' field.
+    Write lookups made since the last flush to the shared index file off the event loop,
+    and pick up the entries other workers wrote in the meantime.
     """
+    global _artist_genres_unsaved
+    unsaved, _artist_genres_unsaved = _artist_genres_unsaved, 0
+    if not unsaved:
+        return
     try:
-        sp = spotipy.Spotify(auth_manager=sp_oauth)
-        results = sp.search(q=f"artist:{song['artist']}", type="artist", limit=1)
-        if results["artists"]["items"]:
-            artist_info = results["artists"]["items"][0]
-            song["labeled_genres"] = artist_info.get("genres", [])
-            song["artist_info"] = artist_info
+        merged = await asyncio.to_thread(
+            write_artist_genres_index, index_entries(_artist_genres_memory), index_entries(_searched_genres_memory)
+        )
+    except Exception:
+        # Runs as a background task, so failures are logged here rather than left unretrieved.
+        logger.exception("Could not write the artist genres index; will retry on the next flush.")
+        _artist_genres_unsaved += unsaved
+        return
+    merge_index_entries(_artist_genres_memory, merged["ids"])
+    merge_index_entries(_searched_genres_memory, merged["names"])
+
+def note_artist_genres_added(count):
+    """
+    Count new memo entries and start a background flush once ARTIST_GENRES_FLUSH_EVERY have gathered.
+    The FastAPI lifespan flushes whatever is left at shutdown.
+    """
+    global _artist_genres_unsaved, _artist_genres_flush_task
+    _artist_genres_unsaved += count
+    flushing = _artist_genres_flush_task is not None and not _artist_genres_flush_task.done()
+    if _artist_genres_unsaved >= ARTIST_GENRES_FLUSH_EVERY and not flushing:
+        _artist_genres_flush_task = asyncio.ensure_future(flush_artist_genres_index())
+
+async def fetch_artist_genres(access_token, artist_ids, debug=False):
+    """
+    Look up genres for many artists with Spotify's bulk artists endpoint (50 ids per call).
+    Returns a dict of artist id -> genre list; chunks that fail are skipped.
+    Artists looked up recently by any request are answered from memory.
+    """
+    load_artist_genres_index()
+    genres_by_artist = {}
+    missing = []
+    for artist_id in dict.fromkeys(artist_ids):
+        if not artist_id:
+            continue
+        genres = recall(_artist_genres_memory, artist_id)
+        if genres is None:
+            missing.append(artist_id)
         else:
-            song["labeled_genres"] = []
-    except Exception as e:
+            genres_by_artist[artist_id] = genres
+    artist_ids = missing
+    chunks = [artist_ids[i:i + SPOTIFY_PAGE_LIMIT] for i in range(0, len(artist_ids), SPOTIFY_PAGE_LIMIT)]
+    results = await asyncio.gather(
+        *(spotify_get(access_token, "artists", {"ids": ",".join(chunk)}) for chunk in chunks),
+        return_exceptions=True
+    )
+    added = 0
+    for result in results:
+        if isinstance(result, Exception):
+            if debug:
+                logger.debug("Artist genre lookup failed: %s", result)
+            continue
+        for artist in result.get("artists", []):
+            if artist:
+                genres_by_artist[artist["id"]] = lowercase_genres(artist.get("genres", []))
+                remember(_artist_genres_memory, artist["id"], genres_by_artist[artist["id"]], ARTIST_GENRES_CACHE_TTL)
+                added += 1
+    note_artist_genres_added(added)
+    return genres_by_artist
+
+async def label_tracks_with_genres(access_token, tracks, debug=False, known_genres=None):
+    """
+    Turn Spotify track objects into songs ('name', 'artist', 'labeled_genres').
+    Genres come from one bulk artist lookup for every artist not already in known_genres.
+    """
+    genres_by_artist = dict(known_genres or {})
+    missing = [track["artists"][0]["id"] for track in tracks if track["artists"][0].get("id") not in genres_by_artist]
+    if missing:
+        genres_by_artist.update(await fetch_artist_genres(access_token, missing, debug))
+    return [
+        {
+            "name": track["name"],
+            "artist": track["artists"][0]["name"],
+            "labeled_genres": genres_by_artist.get(track["artists"][0].get("id"), [])
+        }
+        for track in tracks
+    ]
+
+_labeled_liked_songs_in_flight = {}
+
+async def build_labeled_liked_songs(access_token, debug=False, refresh=False):
+    """
+    Return (labeled_songs, complete), fetching, labeling and caching them when the cache is empty
+    (or always, with refresh=True). Concurrent calls for the same token share a single build
+    instead of each fetching the whole library. The result is shared and must not be mutated.
+    """
+    key = (token_key(access_token), refresh)
+    task = _labeled_liked_songs_in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_build_labeled_liked_songs(access_token, debug, refresh))
+        _labeled_liked_songs_in_flight[key] = task
+        task.add_done_callback(lambda _: _labeled_liked_songs_in_flight.pop(key, None))
+    # Shielded so one caller going away does not cancel the build for the others.
+    return await asyncio.shield(task)
+
+async def _build_labeled_liked_songs(access_token, debug=False, refresh=False):
+    """
+    A partially fetched library is returned with complete=False and not cached.
+    """
+    if not refresh:
+        labeled_songs = load_labeled_liked_songs_cache(access_token, debug=debug)
+        if labeled_songs is not None:
+            return labeled_songs, True
+    liked_songs_raw, complete = await async_get_all_liked_songs(access_token, debug=debug)
+    labeled_songs = await label_tracks_with_genres(access_token, [item["track"] for item in liked_songs_raw], debug)
+    if complete:
+        save_cache(user_cache_filename(LABELED_LIKED_SONGS_CACHE_DIR, access_token), labeled_songs)
         if debug:
-            print(f"[DEBUG] Error labeling song {song['name']} by {song['artist']}: {e}")
-        song["labeled_genres"] = []
-    return song
+            logger.debug("Cached %s labeled liked songs.", len(labeled_songs))
+    return labeled_songs, complete
 
-def cache_labeled_liked_songs(access_token, debug=False):
+async def cache_labeled_liked_songs(access_token, debug=False):
     """
     Pre-fetch all liked songs, enrich each with artist metadata, and cache the labeled results.
     """
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    liked_songs_raw = loop.run_until_complete(async_get_all_liked_songs(access_token, debug=debug))
-    loop.close()
-    liked_songs = [{"name": track["track"]["name"], "artist": track["track"]["artists"][0]["name"]} for track in liked_songs_raw]
-    with ThreadPoolExecutor() as executor:
-        labeled_songs = list(executor.map(lambda s: label_song_with_artist_info(s, debug=debug), liked_songs))
-    filename = os.path.join(CACHE_DIR, "labeled_liked_songs_cache.json")
-    data = {"timestamp": time.time(), "items": labeled_songs}
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f)
-    if debug:
-        print(f"[DEBUG] Cached {len(labeled_songs)} labeled liked songs.")
+    access_token = await resolve_access_token(access_token)
+    labeled_songs, _ = await build_labeled_liked_songs(access_token, debug=debug, refresh=True)
     return labeled_songs
 
-def load_labeled_liked_songs_cache(ttl=43200, debug=False):
+def load_labeled_liked_songs_cache(access_token, ttl=LABELED_LIKED_SONGS_CACHE_TTL, debug=False):
     """
-    Load enriched liked songs data from cache if valid.
+    Load the user's enriched liked songs data from cache if valid.
     """
-    filename = os.path.join(CACHE_DIR, "labeled_liked_songs_cache.json")
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if time.time() - data.get("timestamp", 0) < ttl:
-                if debug:
-                    print(f"[DEBUG] Loaded {len(data.get('items', []))} labeled liked songs from cache.")
-                return data.get("items", [])
+    items = load_cache(user_cache_filename(LABELED_LIKED_SONGS_CACHE_DIR, access_token), ttl)
+    if items is not None and debug:
+        logger.debug("Loaded %s labeled liked songs from cache.", len(items))
+    return items
+
+def liked_index_filename(access_token):
+    digest = hashlib.sha1(access_token.encode("utf-8")).hexdigest()
+    return os.path.join(LIKED_INDEX_CACHE_DIR, f"{digest}.json")
+
+_user_preferences_memory = {}
+_liked_index_memory = {}
+
+def token_key(access_token):
+    return hashlib.blake2b(access_token.encode("utf-8"), digest_size=16).hexdigest()
+
+def remember(memory, key, value, ttl=USER_PREFERENCES_MEMORY_TTL):
+    """
+    Store value in an in-process memo for ttl seconds, evicting the
+    oldest entry once USER_PREFERENCES_MEMORY_MAXSIZE is reached.
+    """
+    memory.pop(key, None)
+    if len(memory) >= USER_PREFERENCES_MEMORY_MAXSIZE:
+        del memory[next(iter(memory))]
+    memory[key] = (time.monotonic() + ttl, value)
+
+def recall(memory, key):
+    entry = memory.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
     return None
 
-def get_user_preferences(access_token=None, debug=False):
-    if access_token:
-        sp = spotipy.Spotify(auth=access_token)
-    else:
-        sp = spotipy.Spotify(auth_manager=sp_oauth)
-    
-    cached_top_artists = load_top_artists_cache()
-    if cached_top_artists is not None:
-        top_artists = cached_top_artists
-        if debug:
-            print(f"[DEBUG] Loaded {len(top_artists)} top artists from cache.")
-    else:
-        top_artists = sp.current_user_top_artists(limit=10)["items"]
-        save_top_artists_cache(top_artists)
-    
+def liked_key(title, artist):
+    # casefold rather than lower, so e.g. "Straße" and "STRASSE" compare equal.
+    return title.strip().casefold(), artist.strip().casefold()
+
+def save_liked_index(access_token, liked_songs):
+    """
+    Persist the normalized (name, artist) keys of the user's liked songs next to their preferences,
+    so playlist requests can flag liked tracks without re-normalizing the whole library.
+    """
+    keys = [liked_key(song["name"], song["artist"]) for song in liked_songs]
+    save_cache(liked_index_filename(access_token), keys)
+    remember(_liked_index_memory, token_key(access_token), frozenset(keys))
+
+def load_liked_index(access_token):
+    key = token_key(access_token)
+    liked_index = recall(_liked_index_memory, key)
+    if liked_index is not None:
+        return liked_index
+    items = load_cache(liked_index_filename(access_token), USER_PREFERENCES_CACHE_TTL)
+    if items is None:
+        return frozenset()
+    liked_index = frozenset(map(tuple, items))
+    remember(_liked_index_memory, key, liked_index)
+    return liked_index
+
+async def get_user_preferences(access_token=None, debug=False):
+    """
+    Return the user's preferences, served from process memory for USER_PREFERENCES_MEMORY_TTL
+    seconds so quick retries skip the disk cache entirely. Entries are keyed by a hash of the token.
+    Preferences built from a partially fetched library are returned but not remembered.
+    """
+    access_token = await resolve_access_token(access_token)
+    key = token_key(access_token)
+    preferences = recall(_user_preferences_memory, key)
+    if preferences is None:
+        preferences = await _fetch_user_preferences(access_token, debug=debug)
+        if not preferences.pop("liked_songs_incomplete", False):
+            remember(_user_preferences_memory, key, preferences)
+    return preferences
+
+# Column view of each user's personal songs, rebuilt only when their memoized preferences change.
+_personal_song_columns_memory = {}
+
+def personal_song_columns(access_token, user_data):
+    """
+    Return the user's liked and top songs as parallel columns for the personal filter:
+    lowercased artists and newline-joined genres (None for songs that were never labeled).
+    """
+    key = token_key(access_token)
+    columns = recall(_personal_song_columns_memory, key)
+    if columns is None or columns["user_data"] is not user_data:
+        songs = user_data["liked_songs"] + user_data["top_tracks"]
+        columns = {
+            "user_data": user_data,
+            "songs": songs,
+            "artists": [song["artist"].lower() for song in songs],
+            "genres": ["\n".join(song["labeled_genres"]) if "labeled_genres" in song else None for song in songs]
+        }
+        remember(_personal_song_columns_memory, key, columns)
+    return columns
+
+def forget_user_data(access_token):
+    """
+    Drop the preferences, library caches and liked index remembered for a token Spotify has rejected,
+    in memory and on disk, so they are not served for an expired or revoked token.
+    """
+    key = token_key(access_token)
+    for memory in (_user_preferences_memory, _liked_index_memory, _personal_song_columns_memory):
+        memory.pop(key, None)
+    filenames = [_fetch_user_preferences.cache_filename((access_token,), {}), liked_index_filename(access_token)]
+    filenames += [
+        user_cache_filename(cache_dir, access_token)
+        for cache_dir in (LIKED_SONGS_CACHE_DIR, TOP_ARTISTS_CACHE_DIR, TOP_TRACKS_CACHE_DIR, LABELED_LIKED_SONGS_CACHE_DIR)
+    ]
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+@cached("user_preferences", ttl=USER_PREFERENCES_CACHE_TTL, should_cache=lambda preferences: "liked_songs_incomplete" not in preferences)
+async def _fetch_user_preferences(access_token, debug=False):
+
+    async def _top_artists():
+        cached_top_artists = load_top_artists_cache(access_token)
+        if cached_top_artists is not None:
+            if debug:
+                logger.debug("Loaded %s top artists from cache.", len(cached_top_artists))
+            return cached_top_artists
+        top_artists = (await spotify_get(access_token, "me/top/artists", {"limit": SPOTIFY_PAGE_LIMIT}))["items"]
+        save_top_artists_cache(access_token, top_artists)
+        return top_artists
+
+    async def _top_tracks():
+        cached_top_tracks = load_top_tracks_cache(access_token)
+        if cached_top_tracks is not None:
+            if debug:
+                logger.debug("Loaded %s top tracks from cache.", len(cached_top_tracks))
+            return cached_top_tracks
+        top_tracks = (await spotify_get(access_token, "me/top/tracks", {"limit": SPOTIFY_PAGE_LIMIT}))["items"]
+        save_top_tracks_cache(access_token, top_tracks)
+        return top_tracks
+
+    top_artists_task = asyncio.ensure_future(_top_artists())
+
+    async def _labeled_top_tracks():
+        top_tracks = await _top_tracks()
+        top_artists = await top_artists_task
+        # Top artists already carry their genres, so only the remaining artists need a lookup.
+        return await label_tracks_with_genres(
+            access_token, top_tracks, debug, known_genres={artist["id"]: lowercase_genres(artist["genres"]) for artist in top_artists}
+        )
+
+    top_artists, track_names, (liked_track_names, liked_complete) = await asyncio.gather(
+        top_artists_task, _labeled_top_tracks(), build_labeled_liked_songs(access_token, debug=debug)
+    )
+
     artist_names = [artist["name"] for artist in top_artists]
     top_genres = list(set([genre for artist in top_artists for genre in artist["genres"]]))
-    
-    cached_top_tracks = load_top_tracks_cache()
-    if cached_top_tracks is not None:
-        top_tracks = cached_top_tracks
-        if debug:
-            print(f"[DEBUG] Loaded {len(top_tracks)} top tracks from cache.")
-    else:
-        top_tracks = sp.current_user_top_tracks(limit=10)["items"]
-        save_top_tracks_cache(top_tracks)
-    track_names = [{"name": track["name"], "artist": track["artists"][0]["name"]} for track in top_tracks]
-    
-    labeled_liked_songs = load_labeled_liked_songs_cache(ttl=43200, debug=debug)
-    if labeled_liked_songs is None:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        liked_songs_raw = loop.run_until_complete(async_get_all_liked_songs(access_token, debug=debug))
-        loop.close()
-        liked_songs = [{"name": track["track"]["name"], "artist": track["track"]["artists"][0]["name"]} for track in liked_songs_raw]
-        with ThreadPoolExecutor() as executor:
-            labeled_liked_songs = list(executor.map(lambda s: label_song_with_artist_info(s, debug=debug), liked_songs))
-        save_cache(LIKED_SONGS_CACHE_FILENAME, liked_songs)
-    liked_track_names = labeled_liked_songs
-    
-    return {
+    preferences = {
         "top_artists": artist_names,
         "top_genres": top_genres,
         "top_tracks": track_names,
         "liked_songs": liked_track_names
     }
+    if liked_complete:
+        save_liked_index(access_token, liked_track_names)
+    else:
+        preferences["liked_songs_incomplete"] = True
+    return preferences
 
-def song_matches_genre(song, target_genres):
-    if "labeled_genres" in song:
-        for tg in target_genres:
-            if any(tg.lower() in g.lower() for g in song["labeled_genres"]):
-                return True
-        return False
-    artist_name = song["artist"]
-    try:
-        sp = spotipy.Spotify(auth_manager=sp_oauth)
-        results = sp.search(q=f"artist:{artist_name}", type="artist", limit=1)
-        if results["artists"]["items"]:
-            artist_info = results["artists"]["items"][0]
-            artist_genres = artist_info.get("genres", [])
-            for tg in target_genres:
-                if any(tg.lower() in ag.lower() for ag in artist_genres):
-                    return True
-        return False
-    except Exception:
-        return False
+def lowercase_genres(genres):
+    return [genre.lower() for genre in genres]
+
+def genres_overlap(target_genres, song_genres):
+    """
+    True if any target genre is a substring of any of the song's genres.
+    Both sides must already be lowercased (song genres are lowercased once, when they are
+    labeled); the song's genres are joined so each target is a single substring search.
+    """
+    joined = "\n".join(song_genres)
+    return any(tg in joined for tg in target_genres)
+
+def artist_search_key(artist_name):
+    return " ".join(artist_name.lower().split())
+
+async def search_artists_genres(access_token, artist_names, debug=False):
+    """
+    Look up genres for many artist names at once, using the best Spotify search match for each.
+    Searches go through spotify_get, so they share its semaphore, rate limiter and 429 retries.
+    Returns a dict of artist name (as given) -> genre list; failed searches map to an empty list.
+    Names differing only in case or spacing are searched once.
+    """
+    load_artist_genres_index()
+    genres_by_key = {}
+    missing = []
+    for key in dict.fromkeys(map(artist_search_key, artist_names)):
+        genres = recall(_searched_genres_memory, key)
+        if genres is None:
+            missing.append(key)
+        else:
+            genres_by_key[key] = genres
+    results = await asyncio.gather(
+        *(spotify_get(access_token, "search", {"q": f"artist:{key}", "type": "artist", "limit": 1}) for key in missing),
+        return_exceptions=True
+    )
+    added = 0
+    for key, result in zip(missing, results):
+        if isinstance(result, Exception):
+            if debug:
+                logger.debug("Artist search failed for %s: %s", key, result)
+            genres_by_key[key] = []
+            continue
+        items = result["artists"]["items"]
+        genres_by_key[key] = lowercase_genres(items[0].get("genres", [])) if items else []
+        remember(_searched_genres_memory, key, genres_by_key[key], ARTIST_GENRES_CACHE_TTL)
+        added += 1
+    note_artist_genres_added(added)
+    return {name: genres_by_key[artist_search_key(name)] for name in artist_names}
+
+async def conditional_get_json(session, url, params=None):
+    """
+    GET a JSON resource, revalidating a previously stored response with its ETag/Last-Modified.
+    A 304 answers from the stored body. A 429 or 5xx is retried after Retry-After (or a short backoff).
+    Returns (status, data); data is None unless the request succeeded.
+    """
+    key = url + "?" + "&".join(f"{name}={value}" for name, value in sorted((params or {}).items()))
+    filename = os.path.join(HTTP_VALIDATORS_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+    stored = load_cache(filename, HTTP_VALIDATORS_CACHE_TTL)
+    headers = {}
+    if stored:
+        if stored.get("etag"):
+            headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified"):
+            headers["If-Modified-Since"] = stored["last_modified"]
+    for attempt in range(EXTERNAL_API_MAX_RETRIES + 1):
+        async with session.get(url, params=params, headers=headers) as resp:
+            delay = retry_delay(resp, attempt, EXTERNAL_API_MAX_RETRIES)
+            if delay is None:
+                if resp.status == 304 and stored:
+                    return 200, stored["body"]
+                if resp.status != 200:
+                    return resp.status, None
+                data = orjson.loads(await resp.read())
+                etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+                break
+        await asyncio.sleep(delay)
+    if etag or last_modified:
+        save_cache(filename, {"etag": etag, "last_modified": last_modified, "body": data})
+    return 200, data
 
-def get_song_metadata(track_name, artist_name):
-    query = f"{track_name} - {artist_name}"
-    query_encoded = quote(query)
-    low_url = f"https://acousticbrainz.org/api/v1/{query_encoded}/low-level"
-    response = requests.get(low_url)
-    bpm = "Unknown"
-    if response.status_code == 200:
-        data = response.json()
-        bpm = data.get("rhythm", {}).get("bpm", "Unknown")
-    if bpm == "Unknown":
-        high_url = f"https://acousticbrainz.org/api/v1/{query_encoded}/high-level"
-        response = requests.get(high_url)
-        if response.status_code == 200:
-            data = response.json()
-            bpm = data.get("rhythm", {}).get("bpm", "Unknown")
+async def fetch_acousticbrainz_bpm(session, query_encoded, level):
+    """
+    Return the BPM, "Unknown" when AcousticBrainz has no BPM for the recording (404, or none in the data),
+    or None when the lookup failed and is worth retrying later.
+    """
+    async with _acousticbrainz_semaphore:
+        status, data = await conditional_get_json(session, f"{ACOUSTICBRAINZ_API_URL}/{query_encoded}/{level}")
+    if data is None:
+        return "Unknown" if status == 404 else None
+    return data.get("rhythm", {}).get("bpm", "Unknown")
+
+@cached("song_metadata", ttl=SONG_METADATA_CACHE_TTL)
+async def fetch_song_metadata(track_name, artist_name):
+    """
+    Look up a song's BPM on AcousticBrainz using the shared session.
+    The low-level and high-level lookups run concurrently; the low-level BPM wins when both have one.
+    Returns None (not cached) when no BPM was found and a lookup failed.
+    """
+    query_encoded = quote(f"{track_name} - {artist_name}")
+    session = await get_http_session()
+    bpms = await asyncio.gather(
+        fetch_acousticbrainz_bpm(session, query_encoded, "low-level"),
+        fetch_acousticbrainz_bpm(session, query_encoded, "high-level")
+    )
+    bpm = next((bpm for bpm in bpms if bpm not in ("Unknown", None)), None)
+    if bpm is None:
+        if None in bpms:
+            return None
+        bpm = "Unknown"
     return {"bpm": bpm, "mood": "Unknown"}
 
-def get_reference_track_details(reference_track, debug=False):
-    if " by " in reference_track.lower():
-        parts = re.split(r"\s+by\s+", reference_track, flags=re.IGNORECASE)
-        track_name = parts[0].strip()
-        artist_name = parts[1].strip() if len(parts) > 1 else None
-    else:
-        track_name = reference_track.strip()
-        artist_name = None
-    api_key = os.environ.get("LASTFM_API_KEY")
-    url = "http://ws.audioscrobbler.com/2.0/"
-    params = {
-         "method": "track.search",
-         "track": track_name,
-         "api_key": api_key,
-         "format": "json",
-         "limit": 5
+# Version and credit decorations: "(Remastered)", "[Live]", " - 2011 Remaster", " feat. Someone".
+_TRACK_DECORATION_RE = re.compile(r"\s*[(\[][^)\]]*[)\]]|\s+-\s+.*$|\s+(?:feat\.?|ft\.|featuring)\s+.*$", re.IGNORECASE)
+
+def metadata_lookup_key(text):
+    """
+    Normalize a track or artist name for metadata lookups, so versions of the same recording
+    share one query and one cache entry.
+    """
+    key = " ".join(_TRACK_DECORATION_RE.sub("", text).casefold().split())
+    return key or " ".join(text.casefold().split())
+
+async def get_song_metadata_batch(pairs, debug=False):
+    """
+    Fetch metadata for a list of (track_name, artist_name) pairs concurrently.
+    Lookups that fail fall back to unknown BPM/mood instead of failing the batch.
+    """
+    results = await asyncio.gather(
+        *(fetch_song_metadata(metadata_lookup_key(track_name), metadata_lookup_key(artist_name)) for track_name, artist_name in pairs),
+        return_exceptions=True
+    )
+    metadata = []
+    for (track_name, artist_name), result in zip(pairs, results):
+        if result is None or isinstance(result, Exception):
+            if debug:
+                logger.debug("Metadata lookup failed for %s by %s: %s", track_name, artist_name, result)
+            result = {"bpm": "Unknown", "mood": "Unknown"}
+        metadata.append(result)
+    return metadata
+
+LASTFM_API_URL = "http://ws.audioscrobbler.com/2.0/"
+
+def lastfm_params(method, **params):
+    params = {"method": method, "api_key": os.environ.get("LASTFM_API_KEY"), "format": "json", **params}
+    return {key: value for key, value in params.items() if value is not None}
+
+@cached("lastfm", ttl=LASTFM_CACHE_TTL)
+async def lastfm_get(params):
+    """
+    GET a Last.fm API method using the shared session.
+    Expired entries are revalidated conditionally. Returns the decoded response, or None when the request
+    did not succeed or timed out.
+    """
+    session = await get_http_session()
+    try:
+        status, data = await conditional_get_json(session, LASTFM_API_URL, params)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug("Last.fm API request failed: %r", e)
+        return None
+    if data is None:
+        logger.debug("Last.fm API error: Status code %s", status)
+    return data
+
+def lastfm_recommendation(title, artist, reason):
+    return {
+        "title": title,
+        "artist": artist,
+        "bpm": "Unknown",
+        "release_year": "Unknown",
+        "liked": False,
+        "mood": "Unknown",
+        "source": "Last.fm",
+        "reason": reason
     }
-    if artist_name:
-        params["artist"] = artist_name
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-         data = response.json()
-         tracks = data.get("results", {}).get("trackmatches", {}).get("track", [])
-         if isinstance(tracks, list) and len(tracks) > 0:
-              return {"title": tracks[0].get("name"), "artist": tracks[0].get("artist")}
-         elif isinstance(tracks, dict):
-              return {"title": tracks.get("name"), "artist": tracks.get("artist")}
+
+_BY_SEPARATOR_RE = re.compile(r"\s+by\s+", re.IGNORECASE)
+
+def split_reference_track(reference_track):
+    """
+    Split "<track> by <artist>" into its parts; the artist is None when no "by" is given.
+    """
+    parts = _BY_SEPARATOR_RE.split(reference_track)
+    if len(parts) > 1:
+        return parts[0].strip(), parts[1].strip()
+    return reference_track.strip(), None
+
+def reference_track_params(reference_track):
+    track_name, artist_name = split_reference_track(reference_track)
+    return lastfm_params("track.search", track=track_name, artist=artist_name, limit=5)
+
+def parse_reference_track(data, reference_track, debug=False):
+    tracks = (data or {}).get("results", {}).get("trackmatches", {}).get("track", [])
+    if isinstance(tracks, list) and len(tracks) > 0:
+        return {"title": tracks[0].get("name"), "artist": tracks[0].get("artist")}
+    elif isinstance(tracks, dict):
+        return {"title": tracks.get("name"), "artist": tracks.get("artist")}
     if debug:
-         print(f"[DEBUG] get_reference_track_details: No track found for '{reference_track}'")
+        logger.debug("fetch_reference_track_details: No track found for '%s'", reference_track)
     return None
 
-def get_top_tracks_lastfm(artist, limit=5, debug=False):
+def parse_top_tracks(data, artist):
+    if data is None:
+        return []
+    return [
+        lastfm_recommendation(track.get("name"), artist, f"Top track from Last.fm for artist {artist}.")
+        for track in data.get("toptracks", {}).get("track", [])
+    ]
+
+def parse_similar_tracks(data, reference_track, reference_artist, debug=False):
+    if data is None:
+        return []
+    if debug:
+        logger.debug("Last.fm raw response: %s", data)
+    similar_tracks = data.get("similartracks", {}).get("track", [])
+    if not similar_tracks and debug:
+        logger.debug("Last.fm returned no similar tracks.")
+    reason = f"Recommended by Last.fm based on reference track '{reference_track}' by '{reference_artist}'."
+    return [
+        lastfm_recommendation(track.get("name"), track.get("artist", {}).get("name"), reason)
+        for track in similar_tracks
+    ]
+
+async def fetch_reference_track_details(reference_track, debug=False):
+    data = await lastfm_get(reference_track_params(reference_track))
+    return parse_reference_track(data, reference_track, debug)
+
+async def fetch_top_tracks_lastfm(artist, limit=5, debug=False):
     """
     Retrieves the top tracks for a given artist using Last.fm's API.
     """
-    api_key = os.environ.get("LASTFM_API_KEY")
-    url = "http://ws.audioscrobbler.com/2.0/"
-    params = {
-        "method": "artist.gettoptracks",
-        "artist": artist,
-        "api_key": api_key,
-        "format": "json",
-        "limit": limit
-    }
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        tracks = data.get("toptracks", {}).get("track", [])
-        recommendations = []
-        for track in tracks:
-            recommendations.append({
-                "title": track.get("name"),
-                "artist": artist,
-                "bpm": "Unknown",
-                "release_year": "Unknown",
-                "liked": False,
-                "mood": "Unknown",
-                "source": "Last.fm",
-                "reason": f"Top track from Last.fm for artist {artist}."
-            })
-        return recommendations
-    else:
-        if debug:
-            print(f"[DEBUG] Last.fm API error: {response.status_code}")
-    return []
-
-def get_similar_tracks_lastfm(reference_track, reference_artist, limit=5, debug=False):
-    api_key = os.environ.get("LASTFM_API_KEY")
-    url = "http://ws.audioscrobbler.com/2.0/"
-    params = {
-         "method": "track.getSimilar",
-         "track": reference_track,
-         "artist": reference_artist,
-         "api_key": api_key,
-         "format": "json",
-         "limit": limit
+    data = await lastfm_get(lastfm_params("artist.gettoptracks", artist=artist, limit=limit))
+    return parse_top_tracks(data, artist)
+
+def similar_tracks_params(reference_track, reference_artist, limit):
+    return lastfm_params("track.getSimilar", track=reference_track, artist=reference_artist, limit=limit)
+
+async def fetch_similar_tracks_lastfm(reference_track, reference_artist, limit=5, debug=False):
+    data = await lastfm_get(similar_tracks_params(reference_track, reference_artist, limit))
+    return parse_similar_tracks(data, reference_track, reference_artist, debug)
+
+QUERY_PROFILES = [
+    (("movie", "soundtrack", "cinematic"), {
+        "label": "Cinematic",
+        "genres": ["orchestral", "cinematic", "electronic", "synthwave", "ambient"],
+        "mood_constraints": ["epic", "dramatic", "adventurous"],
+    }),
+    (("relax", "stress"), {
+        "label": "Relaxation",
+        "genres": ["lofi", "chill", "ambient", "soft rock", "indie"],
+        "mood_constraints": ["calm", "peaceful", "soothing"],
+    }),
+    (("workout", "gym", "running", "exercise", "cardio"), {
+        "label": "Workout",
+        "genres": ["edm", "hip hop", "pop", "electronic"],
+        "mood_constraints": ["energetic", "upbeat", "motivational"],
+        "bpm_range": [120, 160],
+    }),
+    (("study", "focus", "concentrat", "reading"), {
+        "label": "Focus",
+        "genres": ["lofi", "ambient", "classical", "instrumental"],
+        "mood_constraints": ["focused", "calm"],
+        "bpm_range": [60, 100],
+    }),
+    (("sleep", "bedtime"), {
+        "label": "Sleep",
+        "genres": ["ambient", "classical", "piano"],
+        "mood_constraints": ["calm", "dreamy", "soothing"],
+        "bpm_range": [50, 80],
+    }),
+    (("party", "dance"), {
+        "label": "Party",
+        "genres": ["pop", "dance", "edm", "hip hop"],
+        "mood_constraints": ["energetic", "happy", "upbeat"],
+        "bpm_range": [110, 135],
+    }),
+    (("sad", "heartbreak", "breakup"), {
+        "label": "Melancholy",
+        "genres": ["indie", "acoustic", "pop"],
+        "mood_constraints": ["sad", "melancholic", "emotional"],
+        "bpm_range": [60, 100],
+    }),
+]
+
+# Flattened trigger -> profile map; dict order keeps the QUERY_PROFILES priority.
+_PROFILE_BY_KEYWORD = {term: profile for triggers, profile in QUERY_PROFILES for term in triggers}
+# Phrases that restrict the playlist to the user's own library. Longer variants such as
+# "using only my liked songs" are covered by their shorter substrings.
+_ONLY_USER_TERMS = frozenset({
+    "only my liked songs", "using my liked songs", "using my favorites", "only my favorites",
+    "only my favourites", "only my favorite songs", "only my favourite songs", "only my top tracks"
+})
+_KNOWN_GENRES = ("bollywood", "hollywood", "disney", "pop", "rock", "hip hop", "rap", "jazz", "classical", "electronic", "edm", "country", "indie", "metal", "reggae", "r&b")
+_INSTRUMENTS = ("guitar", "piano", "violin", "drums", "saxophone", "flute", "bass", "cello", "trumpet", "harp", "ukulele", "mandolin")
+_EXCLUDE_ARTIST_TERMS = frozenset({"not his music", "not her music", "not their music"})
+_GRADUAL_TERMS = frozenset({"increase", "progress"})
+# Every keyword above in one pattern: a single findall over the lowercased query yields all
+# keywords it contains (the lookahead lets matches overlap, same as separate 'in' checks).
+_KEYWORD_RE = re.compile("(?=(" + "|".join(sorted(
+    map(re.escape, {*_PROFILE_BY_KEYWORD, *_ONLY_USER_TERMS, *_KNOWN_GENRES, *_INSTRUMENTS, *_GRADUAL_TERMS, *_EXCLUDE_ARTIST_TERMS}),
+    key=len, reverse=True
+)) + "))")
+# Theme, genre and instrument keywords must start a word to be trusted ("relaxing" counts, "therapy" -> rap does not).
+_KEYWORD_WORD_START_RES = {
+    term: re.compile(r"\b" + re.escape(term)) for term in {*_PROFILE_BY_KEYWORD, *_KNOWN_GENRES, *_INSTRUMENTS}
+}
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(hour|hr|min|minutes)", re.IGNORECASE)
+# One scan finds both a BPM range ("120-140 bpm") and a bare mention of BPM.
+_BPM_RE = re.compile(r"(\d+)\s*(?:-|to)\s*(\d+)\s*bpm|\bbpm\b", re.IGNORECASE)
+_YEAR_RANGE_RE = re.compile(r"\b((?:19|20)\d{2})\s*(?:-|to)\s*((?:19|20)\d{2})\b")
+_DECADE_RE = re.compile(r"\b((?:19|20)?\d0)'?s\b")
+# A count may be followed by a few describing words ("30 rock songs", "25 upbeat pop tracks"), but not by a unit.
+_SONG_COUNT_RE = re.compile(
+    r"\b(\d{1,3})(?:\s+(?!(?:hours?|hrs?|min(?:ute)?s?|bpm)\b)[a-z&'-]+){0,3}?\s*(?:songs|tracks)\b", re.IGNORECASE
+)
+_NUMBER_RE = re.compile(r"\d+")
+# Only the explicit "songs/music/tracks by <name>" form at the end of the query, with no digits in the name,
+# so "listen by the pool" or "increase the bpm by 10" are not taken for artists.
+_TARGET_ARTIST_RE = re.compile(r"\b(?:songs|music|tracks)\s+by\s+([^\W\d_]+(?:[\s'&.-]+[^\W\d_]+)*)\s*$", re.IGNORECASE)
+_SOUND_LIKE_RE = re.compile(r"sound like ([\w\s]+?)\s+but")
+# Punctuation that only separates words; "-", "'", "&" and "." carry meaning (120-140, 80's, r&b, 1.5 hours).
+_QUERY_PUNCTUATION = str.maketrans({ch: " " for ch in ',;:!?"()[]{}'})
+_REFERENCE_HINT_RE = re.compile(r"\b(?:like|similar to)\b")
+# How often interpret_user_query could skip the model, for tuning the confidence rule.
+_QUERY_PARSE_STATS = {"local": 0, "llm": 0}
+
+# The instructions are fixed and the query goes last, so every request shares the same prompt prefix.
+CONSTRAINT_EXTRACTION_PROMPT = string.Template("""
+    Extract playlist constraints from the query at the end of this message; use null for anything not mentioned.
+    If a song count is mentioned, set "explicit_song_count" to that number; otherwise, null.
+    If a specific song is mentioned (e.g., "like Halloween by Novo Amor"), set "reference_track" accordingly; otherwise, null.
+    If an instrument is mentioned (e.g., "guitar pieces"), set "instrument" accordingly.
+    Query: "$user_query"
+    """)
+
+def nullable(schema):
+    return {**schema, "type": [schema["type"], "null"]}
+
+QUERY_CONSTRAINTS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "playlist_constraints",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "explicit_song_count": nullable({"type": "integer"}),
+                "duration_minutes": nullable({"type": "integer"}),
+                "bpm_range": nullable({"type": "array", "items": {"type": "integer"}}),
+                "genres": nullable({"type": "array", "items": {"type": "string"}}),
+                "release_year_range": nullable({"type": "array", "items": {"type": "integer"}}),
+                "mood_constraints": nullable({"type": "array", "items": {"type": "string"}}),
+                "use_only_user_songs": nullable({"type": "boolean"}),
+                "reference_track": nullable({"type": "string"}),
+                "instrument": nullable({"type": "string"})
+            },
+            "required": [
+                "explicit_song_count", "duration_minutes", "bpm_range", "genres", "release_year_range",
+                "mood_constraints", "use_only_user_songs", "reference_track", "instrument"
+            ],
+            "additionalProperties": False
+        }
     }
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-         raw = response.text
-         if debug:
-             print(f"[DEBUG] Last.fm raw response: {raw}")
-         data = response.json()
-         similar_tracks = data.get("similartracks", {}).get("track", [])
-         if not similar_tracks and debug:
-             print("[DEBUG] Last.fm returned no similar tracks.")
-         recommendations = []
-         for track in similar_tracks:
-             recommendations.append({
-                  "title": track.get("name"),
-                  "artist": track.get("artist", {}).get("name"),
-                  "bpm": "Unknown",
-                  "release_year": "Unknown",
-                  "liked": False,
-                  "mood": "Unknown",
-                  "source": "Last.fm",
-                  "reason": f"Recommended by Last.fm based on reference track '{reference_track}' by '{reference_artist}'."
-             })
-         return recommendations
-    else:
-         if debug:
-             print(f"[DEBUG] Last.fm API error: Status code {response.status_code}")
-    return []
+}
 
-def interpret_user_query(user_query, debug=False):
+def build_constraint_extraction_prompt(user_query):
+    return CONSTRAINT_EXTRACTION_PROMPT.substitute(user_query=user_query)
+
+@cached("query_constraints", ttl=QUERY_CONSTRAINTS_CACHE_TTL)
+async def request_query_constraints(normalized_query):
+    """
+    Ask the model to extract constraints for a query the keyword rules could not classify.
+    """
+    async with _openai_semaphore:
+        response = await get_openai_client().chat.completions.create(
+            model=OPENAI_EXTRACT_MODEL,
+            messages=[
+                {"role": "system", "content": "Extract playlist constraints as JSON."},
+                {"role": "user", "content": build_constraint_extraction_prompt(normalized_query)}
+            ],
+            temperature=0.5,
+            max_tokens=OPENAI_CONSTRAINTS_MAX_TOKENS,
+            response_format=QUERY_CONSTRAINTS_RESPONSE_FORMAT
+        )
+    return orjson.loads(response.choices[0].message.content)
+
+# In-flight constraint extractions by normalized query, so identical concurrent queries share one model call.
+_query_constraints_in_flight = {}
+
+async def coalesced_query_constraints(normalized_query):
+    task = _query_constraints_in_flight.get(normalized_query)
+    if task is None:
+        task = asyncio.ensure_future(request_query_constraints(normalized_query))
+        _query_constraints_in_flight[normalized_query] = task
+        task.add_done_callback(lambda _: _query_constraints_in_flight.pop(normalized_query, None))
+    # Shielded so one caller going away does not cancel the call for the others; each caller
+    # gets its own copy because interpret_user_query fills in the result in place.
+    return copy.deepcopy(await asyncio.shield(task))
+
+async def interpret_user_query(user_query, debug=False, force_llm=False):
     reasoning = [] if debug else None
     if debug:
         reasoning.append(f"I received the following query: '{user_query}'.")
-    duration_match = re.search(r"(\d+(\.\d+)?)\s*(hour|hr|min|minutes)", user_query, re.IGNORECASE)
+    text = user_query.translate(_QUERY_PUNCTUATION)
+    q = text.lower()
+    duration_match = _DURATION_RE.search(text)
     extracted_duration = None
     if duration_match:
         duration_value = float(duration_match.group(1))
-        if "hour" in duration_match.group(3).lower():
+        if duration_match.group(2)[0] in "hH":  # "hour" or "hr"
             extracted_duration = int(duration_value * 60)
         else:
             extracted_duration = int(duration_value)
@@ -389,62 +1229,75 @@ def interpret_user_query(user_query, debug=False):
         if debug:
             reasoning.append("No explicit duration found; defaulting to 60 minutes.")
         extracted_duration = 60
+    keywords = set(_KEYWORD_RE.findall(q))
     genres, mood_constraints = [], []
-    if any(term in user_query.lower() for term in ["movie", "soundtrack", "cinematic"]):
-        genres = ["orchestral", "cinematic", "electronic", "synthwave", "ambient"]
-        mood_constraints = ["epic", "dramatic", "adventurous"]
-        if debug:
-            reasoning.append("Cinematic theme detected; set genres and mood constraints accordingly.")
-    elif any(term in user_query.lower() for term in ["relax", "stress"]):
-        genres = ["lofi", "chill", "ambient", "soft rock", "indie"]
-        mood_constraints = ["calm", "peaceful", "soothing"]
+    bpm_range = [60, 130]
+    profile_term = next((term for term in _PROFILE_BY_KEYWORD if term in keywords), None)
+    detected_genre = None
+    if profile_term is not None:
+        profile = _PROFILE_BY_KEYWORD[profile_term]
+        genres = list(profile["genres"])
+        mood_constraints = list(profile["mood_constraints"])
+        bpm_range = list(profile.get("bpm_range", bpm_range))
         if debug:
-            reasoning.append("Relaxation theme detected; set calming genres and mood constraints.")
+            reasoning.append(f"{profile['label']} theme detected; set genres, mood and BPM constraints accordingly.")
     else:
-        known_genres = ["bollywood", "hollywood", "disney", "pop", "rock", "hip hop", "rap", "jazz", "classical", "electronic", "edm", "country", "indie", "metal", "reggae", "r&b"]
-        detected_genre = None
-        for genre in known_genres:
-            if genre in user_query.lower():
-                detected_genre = genre
-                if debug:
-                    reasoning.append(f"Detected specific genre: {genre}.")
-                break
+        detected_genre = next((genre for genre in _KNOWN_GENRES if genre in keywords), None)
         if detected_genre:
             genres = [detected_genre]
+            if debug:
+                reasoning.append(f"Detected specific genre: {detected_genre}.")
+    bpm_matches = list(_BPM_RE.finditer(text))
+    bpm_match = next((match for match in bpm_matches if match.group(1)), None)
+    if bpm_match:
+        bpm_range = sorted([int(bpm_match.group(1)), int(bpm_match.group(2))])
+        if debug:
+            reasoning.append(f"Extracted BPM range: {bpm_range}.")
+    release_year_range = [2019, 2024]
+    year_match = _YEAR_RANGE_RE.search(text)
+    decade_match = None if year_match else _DECADE_RE.search(text)
+    if year_match:
+        release_year_range = sorted([int(year_match.group(1)), int(year_match.group(2))])
+    elif decade_match:
+        decade = int(decade_match.group(1))
+        if decade < 100:
+            decade += 1900 if decade >= 30 else 2000
+        release_year_range = [decade, decade + 9]
+    if debug and (year_match or decade_match):
+        reasoning.append(f"Extracted release years: {release_year_range}.")
+    explicit_song_count = None
+    count_match = _SONG_COUNT_RE.search(text)
+    if count_match:
+        explicit_song_count = int(count_match.group(1))
+        if debug:
+            reasoning.append(f"Extracted song count: {explicit_song_count}.")
     if debug and not genres:
         reasoning.append("No specific genre detected; defaulting to 'any'.")
-    concern_bpm = bool(re.search(r"\bBPM\b", user_query, re.IGNORECASE))
+    concern_bpm = bool(bpm_matches)
     if debug:
         reasoning.append("BPM validation " + ("enabled." if concern_bpm else "skipped."))
-    use_only_user_songs = any(
-        term in user_query.lower() for term in ["only my liked songs", "using my liked songs", "using my favorites", "using only my liked songs", "using only my favorites"]
-    )
+    use_only_user_songs = not _ONLY_USER_TERMS.isdisjoint(keywords)
     if debug:
         reasoning.append("Personal songs constraint " + ("enabled." if use_only_user_songs else "not specified."))
-    gradual_bpm = bool(re.search(r"(increase|progress)", user_query, re.IGNORECASE))
+    gradual_bpm = not _GRADUAL_TERMS.isdisjoint(keywords)
     if debug and gradual_bpm:
         reasoning.append("Gradual BPM progression requested.")
-    instrument_list = ["guitar", "piano", "violin", "drums", "saxophone", "flute", "bass", "cello", "trumpet", "harp", "ukulele", "mandolin"]
-    detected_instrument = None
-    for inst in instrument_list:
-        if inst in user_query.lower():
-            detected_instrument = inst
-            if debug:
-                reasoning.append(f"Detected instrument: {inst}.")
-            break
+    detected_instrument = next((inst for inst in _INSTRUMENTS if inst in keywords), None)
+    if debug and detected_instrument:
+        reasoning.append(f"Detected instrument: {detected_instrument}.")
     target_artist = None
-    m = re.search(r"by ([\w\s]+)$", user_query, re.IGNORECASE)
+    m = _TARGET_ARTIST_RE.search(text)
     if m:
         target_artist = m.group(1).strip()
         if debug:
             reasoning.append(f"Detected target artist: {target_artist}.")
-    exclude_artist_flag = "not his music" in user_query.lower() or "but are not his music" in user_query.lower()
+    exclude_artist_flag = not keywords.isdisjoint(_EXCLUDE_ARTIST_TERMS)
     extracted_data = {
-        "explicit_song_count": None,
+        "explicit_song_count": explicit_song_count,
         "duration_minutes": extracted_duration,
-        "bpm_range": [60, 130],
+        "bpm_range": bpm_range,
         "genres": genres if genres else ["any"],
-        "release_year_range": [2019, 2024],
+        "release_year_range": release_year_range,
         "mood_constraints": mood_constraints if mood_constraints else [],
         "use_only_user_songs": use_only_user_songs,
         "reference_track": None,
@@ -454,69 +1307,61 @@ def interpret_user_query(user_query, debug=False):
         "exclude_artist": None,
         "target_artist": target_artist
     }
-    prompt = f"""
-    Please extract structured playlist constraints from the following query:
-    "{user_query}"
-    
-    The JSON response should include: 
-    "explicit_song_count", "duration_minutes", "bpm_range", "genres", "release_year_range", "mood_constraints", "use_only_user_songs", "reference_track", "instrument".
-    If a song count is mentioned, set "explicit_song_count" to that number; otherwise, null.
-    If a specific song is mentioned (e.g., "like Halloween by Novo Amor"), set "reference_track" accordingly; otherwise, null.
-    If an instrument is mentioned (e.g., "guitar pieces"), set "instrument" accordingly.
-    """
-    if debug:
-        reasoning.append("Constructed prompt for OpenAI API:")
-        reasoning.append(prompt)
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Extract playlist constraints as JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.5
-        )
-        raw_content = response.choices[0].message.content.strip()
-        if debug:
-            reasoning.append(f"OpenAI API returned: {raw_content}")
-        raw_content = raw_content.strip("```json").strip("```").strip()
-        extracted_json = json.loads(raw_content)
-    except json.JSONDecodeError as e:
+    # The rules are trusted when they found something to build on and the query does not point at a
+    # reference song (other than the "sound like ... but" form the regex below extracts itself).
+    # Keywords found inside other words ("therapy" -> rap) and numbers none of the patterns
+    # explained are left for the model to interpret.
+    sound_like_match = _SOUND_LIKE_RE.search(q)
+    needs_reference = bool(_REFERENCE_HINT_RE.search(q)) and not sound_like_match
+    explained_spans = [
+        match.span() for match in (duration_match, year_match, decade_match, count_match, *bpm_matches) if match
+    ]
+    unexplained_number = any(
+        not any(start <= number.start() and number.end() <= end for start, end in explained_spans)
+        for number in _NUMBER_RE.finditer(text)
+    )
+    partial_keyword = any(
+        not _KEYWORD_WORD_START_RES[term].search(q) for term in (profile_term, detected_genre, detected_instrument) if term
+    )
+    # A target artist alone is not enough: the model still sees those queries, in case "by ..." was not an artist.
+    locally_confident = (
+        bool(genres or mood_constraints or detected_instrument)
+        and not (needs_reference or unexplained_number or partial_keyword)
+    )
+    _QUERY_PARSE_STATS["local" if locally_confident and not force_llm else "llm"] += 1
+    logger.debug("Queries parsed without the model: %s of %s.", _QUERY_PARSE_STATS["local"], sum(_QUERY_PARSE_STATS.values()))
+    if locally_confident and not force_llm:
         if debug:
-            reasoning.append(f"JSON decode error: {e}. Using default constraints.")
+            reasoning.append("Keyword rules covered the query; skipping the OpenAI constraint extraction.")
         extracted_json = {}
-    except Exception as e:
+    else:
+        normalized_query = " ".join(q.split())
         if debug:
-            reasoning.append(f"Error calling OpenAI API: {e}. Using default constraints.")
-        extracted_json = {}
-    if extracted_json.get("duration_minutes") is None:
-        extracted_json["duration_minutes"] = extracted_duration
-    if extracted_json.get("bpm_range") is None:
-        extracted_json["bpm_range"] = [60, 130]
-    if extracted_json.get("genres") is None:
-        extracted_json["genres"] = genres if genres else ["any"]
-    if extracted_json.get("release_year_range") is None:
-        extracted_json["release_year_range"] = [2019, 2024]
-    if extracted_json.get("mood_constraints") is None:
-        extracted_json["mood_constraints"] = mood_constraints if mood_constraints else []
-    if extracted_json.get("use_only_user_songs") is None:
-        extracted_json["use_only_user_songs"] = use_only_user_songs
-    if extracted_json.get("explicit_song_count") is None:
-        extracted_json["explicit_song_count"] = None
-    if extracted_json.get("reference_track") is None:
-        extracted_json["reference_track"] = None
-    if extracted_json.get("instrument") is None:
-        extracted_json["instrument"] = detected_instrument
+            reasoning.append("Constructed prompt for OpenAI API:")
+            reasoning.append(build_constraint_extraction_prompt(normalized_query))
+        try:
+            extracted_json = await coalesced_query_constraints(normalized_query)
+            if debug:
+                reasoning.append(f"OpenAI API returned: {extracted_json}")
+        except orjson.JSONDecodeError as e:
+            if debug:
+                reasoning.append(f"JSON decode error: {e}. Using default constraints.")
+            extracted_json = {}
+        except Exception as e:
+            if debug:
+                reasoning.append(f"Error calling OpenAI API: {e}. Using default constraints.")
+            extracted_json = {}
+    # Model values win unless they are null; the local extraction fills every other key.
+    extracted_json = {**extracted_data, **{key: value for key, value in extracted_json.items() if value is not None}}
     extracted_json["concern_bpm"] = concern_bpm
     extracted_json["gradual_bpm"] = gradual_bpm
     if not extracted_json.get("reference_track"):
-        m = re.search(r'sound like ([\w\s]+?)\s+but', user_query.lower())
-        if m:
-            extracted_json["reference_track"] = m.group(1).strip()
+        if sound_like_match:
+            extracted_json["reference_track"] = sound_like_match.group(1).strip()
             if debug:
                 reasoning.append(f"Extracted reference track via regex: {extracted_json['reference_track']}")
     if exclude_artist_flag and extracted_json.get("reference_track"):
-        ref_details = get_reference_track_details(extracted_json["reference_track"], debug)
+        ref_details = await fetch_reference_track_details(extracted_json["reference_track"], debug)
         if ref_details and ref_details.get("artist"):
             extracted_json["exclude_artist"] = ref_details.get("artist").strip().lower()
         else:
@@ -546,54 +1391,304 @@ def validate_playlist(playlist, constraints, debug=False):
     if constraints.get("exclude_artist"):
         header += f"- Excluding artist: {constraints.get('exclude_artist')}.\n"
     validation_log.append(header)
+    gradual_bpm = constraints.get("gradual_bpm")
+    concern_bpm = constraints.get("concern_bpm")
+    if gradual_bpm or concern_bpm:
+        bpm_low, bpm_high = constraints["bpm_range"][0], constraints["bpm_range"][1]
+        bpm_step = (bpm_high - bpm_low) / (len(playlist) - 1) if len(playlist) > 1 else 0
+        fallback_bpm = int((bpm_low + bpm_high) / 2)
+    mood_constraints = constraints.get("mood_constraints")
     for i, song in enumerate(playlist):
         msg = f"Song '{song['title']}' by {song['artist']}: "
-        if constraints.get("gradual_bpm"):
-            num_songs = len(playlist)
-            expected_bpm = constraints["bpm_range"][0]
-            if num_songs > 1:
-                expected_bpm += i * (constraints["bpm_range"][1] - constraints["bpm_range"][0]) / (num_songs - 1)
-            msg += f"Expected BPM around {round(expected_bpm)}. "
+        if gradual_bpm:
+            expected_bpm = round(bpm_low + i * bpm_step)
+            msg += f"Expected BPM around {expected_bpm}. "
             if "bpm" in song and song["bpm"] != "Unknown":
                 bpm = song["bpm"]
-                if constraints["bpm_range"][0] <= bpm <= constraints["bpm_range"][1]:
+                if bpm_low <= bpm <= bpm_high:
                     msg += f"Actual BPM is {bpm} (within range). "
                 else:
                     msg += f"Actual BPM is {bpm} (outside range). "
             else:
-                song["bpm"] = round(expected_bpm)
-                msg += f"Assigned expected BPM of {round(expected_bpm)}. "
-        elif constraints.get("concern_bpm"):
+                song["bpm"] = expected_bpm
+                msg += f"Assigned expected BPM of {expected_bpm}. "
+        elif concern_bpm:
             if "bpm" in song and song["bpm"] != "Unknown":
                 bpm = song["bpm"]
-                if constraints["bpm_range"][0] <= bpm <= constraints["bpm_range"][1]:
+                if bpm_low <= bpm <= bpm_high:
                     msg += f"BPM {bpm} is within range. "
                 else:
                     msg += f"BPM {bpm} is outside the range {constraints['bpm_range']}. "
             else:
-                fallback_bpm = int((constraints["bpm_range"][0] + constraints["bpm_range"][1]) / 2)
                 song["bpm"] = fallback_bpm
                 msg += f"Assigned fallback BPM of {fallback_bpm}. "
         else:
             msg += "No BPM validation performed. "
+        mood = song.get("mood", "Unknown")
+        if mood_constraints and mood != "Unknown":
+            if matches_mood(mood, mood_constraints):
+                msg += f"Mood '{mood}' matches {constraints['mood_constraints']}. "
+            else:
+                msg += f"Mood '{mood}' does not match {constraints['mood_constraints']}. "
         if "source" in song and "reason" in song:
             msg += f"Source: {song['source']} because {song['reason']}."
         else:
             msg += "No additional source info."
+        if song.get("explanation"):
+            msg += f" Why: {song['explanation']}"
         validation_log.append(msg)
     return validation_log
 
-def generate_constrained_playlist(user_query, access_token=None, debug=False):
+AI_SONGS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "playlist",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "songs": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {"type": "string"},
+                            "artist": {"type": "string"},
+                            "bpm": {"type": "integer"},
+                            "release_year": {"type": "integer"},
+                            "mood": {"type": "string"},
+                            "reason": {"type": "string"}
+                        },
+                        "required": ["title", "artist", "bpm", "release_year", "mood", "reason"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["songs"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def normalize_constraint_values(values):
+    return sorted({str(value).strip().lower() for value in values or []})
+
+AI_PLAYLIST_PROMPT = string.Template("""
+    Give each song a one-sentence "reason" it fits. Generate a playlist with the following constraints:
+    - Genre: $genres
+    - BPM range: $bpm_start to $bpm_end
+    - Release years: $year_start to $year_end
+    - Mood constraints: $mood_constraints
+    - Number of songs: $needed
+    $reference_line
+    $instrument_line
+    """)
+
+def build_ai_playlist_prompt(genres, bpm_start, bpm_end, release_year_range, mood_constraints, needed,
+                             reference_track=None, instrument=None):
     """
-    Generates a playlist based on the user query and enriches each track with its album cover and track URI.
-    If a song cannot be found with an album cover, an alternative song is generated that fits the user query constraints.
+    Build the playlist top-up prompt from normalized constraints.
+    The static instructions come first so OpenAI's prompt cache can reuse the prefix, and
+    equivalent constraint sets always produce the same prompt (and therefore the same cache key).
     """
-    if debug:
-        constraints, reasoning = interpret_user_query(user_query, debug=debug)
-    else:
-        constraints = interpret_user_query(user_query, debug=debug)
-        reasoning = None
-    constraints["user_query"] = user_query
+    reference_line = ""
+    if reference_track:
+        reference_line = f"Reference track: {reference_track.strip().lower()}. Generate similar songs."
+    instrument_line = ""
+    if instrument:
+        instrument_line = f"Include songs with prominent {instrument.strip().lower()}."
+    return AI_PLAYLIST_PROMPT.substitute(
+        genres=normalize_constraint_values(genres),
+        bpm_start=bpm_start,
+        bpm_end=bpm_end,
+        year_start=release_year_range[0],
+        year_end=release_year_range[1],
+        mood_constraints=normalize_constraint_values(mood_constraints),
+        needed=needed,
+        reference_line=reference_line,
+        instrument_line=instrument_line
+    )
+
+class SongStreamParser:
+    """
+    Incrementally extract the song objects from a streamed {"songs": [{...}, ...]} document,
+    so each song is available as soon as its closing brace arrives.
+    """
+    SONG_DEPTH = 3  # root object -> "songs" array -> song object
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.buffer = []
+
+    def feed(self, text):
+        songs = []
+        for ch in text:
+            if self.depth >= self.SONG_DEPTH:
+                self.buffer.append(ch)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth == self.SONG_DEPTH:
+                    self.buffer = [ch]
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == self.SONG_DEPTH - 1 and ch == "}":
+                    songs.append(orjson.loads("".join(self.buffer)))
+                    self.buffer = []
+        return songs
+
+async def stream_ai_songs(prompt, max_tokens=OPENAI_MAX_SONG_TOKENS, outcome=None):
+    """
+    Stream the model's answer and yield each song as soon as it has been fully generated.
+    If an outcome dict is given, its "finish_reason" is set from the final chunk ("length" when cut off at max_tokens).
+    """
+    parser = SongStreamParser()
+    async with _openai_semaphore:
+        stream = await get_openai_client().chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a music expert AI that generates playlists."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            response_format=AI_SONGS_RESPONSE_FORMAT,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason and outcome is not None:
+                outcome["finish_reason"] = choice.finish_reason
+            delta = choice.delta.content
+            if delta:
+                for song in parser.feed(delta):
+                    yield song
+
+AI_SONGS_CACHE_DIR = os.path.join(CACHE_DIR, "ai_songs")
+os.makedirs(AI_SONGS_CACHE_DIR, exist_ok=True)
+
+def ai_songs_cache_filename(prompt, needed):
+    # Same key layout as cached(), so answers stored before songs were streamed stay valid.
+    key = f"prompt={prompt!r}|needed={needed!r}"
+    return os.path.join(AI_SONGS_CACHE_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+async def iter_ai_songs(prompt, needed, refresh=False):
+    """
+    Yield the model's songs for the prompt as they stream in, so callers can start on each song
+    while the rest are still being generated. Complete, non-empty answers are cached for
+    AI_SONGS_CACHE_TTL (skipped with refresh=True); answers cut off at the token cap are not.
+    Every yielded song is the caller's own copy.
+    """
+    filename = ai_songs_cache_filename(prompt, needed)
+    songs = None if refresh else load_cache(filename, AI_SONGS_CACHE_TTL)
+    if songs is not None:
+        for song in songs:
+            yield dict(song)
+        return
+    songs = []
+    outcome = {}
+    async for song in stream_ai_songs(prompt, max_tokens=song_tokens_budget(needed), outcome=outcome):
+        songs.append(dict(song))
+        yield song
+    if songs and outcome.get("finish_reason") != "length":
+        save_cache(filename, songs)
+
+SONG_EXPLANATION_PROMPT = string.Template("""
+    Respond with a JSON object whose "explanations" list holds one object per song with keys "index" and "why".
+    In one sentence each, explain why every numbered song below fits this playlist request.
+    Request: "$user_query"
+    Songs:
+    $songs
+    """)
+
+EXPLANATION_BATCH_SIZE = 25  # Keeps each answer well inside its output-token cap.
+
+async def explain_songs_batch(songs, constraints):
+    """
+    Explain why each song fits the request, with one model call per EXPLANATION_BATCH_SIZE songs
+    (run concurrently). Returns one explanation per song, in order; songs the model skipped get an empty string.
+    """
+    if not songs:
+        return []
+    if len(songs) > EXPLANATION_BATCH_SIZE:
+        batches = await asyncio.gather(*(
+            explain_songs_batch(songs[start:start + EXPLANATION_BATCH_SIZE], constraints)
+            for start in range(0, len(songs), EXPLANATION_BATCH_SIZE)
+        ))
+        return [explanation for batch in batches for explanation in batch]
+    song_lines = "\n    ".join(
+        f"{i}. {song.get('title') or song.get('name')} by {song['artist']}" for i, song in enumerate(songs)
+    )
+    prompt = SONG_EXPLANATION_PROMPT.substitute(user_query=constraints.get("user_query", ""), songs=song_lines)
+    async with _openai_semaphore:
+        response = await get_openai_client().chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a music expert AI that explains playlist choices in JSON."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            max_tokens=song_tokens_budget(len(songs)),
+            response_format={"type": "json_object"}
+        )
+    explanations = [""] * len(songs)
+    for item in orjson.loads(response.choices[0].message.content).get("explanations", []):
+        index = item.get("index")
+        if isinstance(index, int) and 0 <= index < len(songs):
+            explanations[index] = item.get("why", "")
+    return explanations
+
+# Background cover requests are referenced here until they finish so they are not garbage-collected mid-flight.
+_cover_preload_tasks = set()
+
+async def head_album_cover(url):
+    try:
+        session = await get_http_session()
+        async with session.head(url, allow_redirects=True):
+            pass
+    except Exception as e:
+        logger.debug("Album cover preload failed for %s: %s", url, e)
+
+def preload_album_cover(url):
+    """
+    Request an album cover in the background so the image CDN has it cached by the time
+    the client fetches it. The playlist never waits on this.
+    """
+    task = asyncio.ensure_future(head_album_cover(url))
+    _cover_preload_tasks.add(task)
+    task.add_done_callback(_cover_preload_tasks.discard)
+
+def playlist_entry(song):
+    get = song.get
+    return {"title": get("name") or get("title"),
+            "artist": song["artist"],
+            "liked": get("liked", False),
+            "mood": get("mood", "Unknown"),
+            "source": get("source", "unknown"),
+            "reason": get("reason", "No reason provided"),
+            "bpm": get("bpm", "Unknown"),
+            "album_cover": get("album_cover"),
+            "uri": get("uri")}
+
+async def iter_constrained_playlist(constraints, access_token=None, reasoning=None, refresh=False):
+    """
+    Build the playlist for already-interpreted constraints, yielding each entry as soon as its
+    Spotify enrichment completes. Reasoning lines are appended to `reasoning` when it is a list.
+    With refresh=True the AI top-up is generated anew instead of reusing a cached answer.
+    """
+    debug = reasoning is not None
     if constraints.get("explicit_song_count") is not None:
         num_songs = int(constraints["explicit_song_count"])
         if debug:
@@ -614,33 +1709,47 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
         bpm_start, bpm_end = bpm_range
     else:
         bpm_start, bpm_end = 60, 130
+    access_token = await resolve_access_token(access_token)
     filtered_songs = []
     if use_only_user_songs:
-        user_data = get_user_preferences(access_token=access_token, debug=debug)
-        user_songs = user_data["liked_songs"] + user_data["top_tracks"]
-        with ThreadPoolExecutor() as executor:
-            futures = {}
-            for song in user_songs:
-                if constraints.get("target_artist"):
-                    if constraints["target_artist"].lower() not in song["artist"].lower():
-                        continue
-                futures[executor.submit(song_matches_genre, song, genres)] = song
-            for future in futures:
-                try:
-                    if future.result():
-                        song = futures[future]
-                        song["source"] = "personal"
-                        song["reason"] = f"Matches genre constraint {genres}."
-                        filtered_songs.append(song)
-                        if debug:
-                            reasoning.append(f"Song '{song['name']}' by {song['artist']} matches genre {genres}.")
-                except Exception:
-                    continue
+        user_data = await get_user_preferences(access_token=access_token, debug=debug)
+        columns = personal_song_columns(access_token, user_data)
+        songs, song_genres = columns["songs"], columns["genres"]
+        candidates = range(len(songs))
+        if constraints.get("target_artist"):
+            target_artist = constraints["target_artist"].lower()
+            candidates = [i for i, artist in enumerate(columns["artists"]) if target_artist in artist]
+        # Songs labeled at cache time are matched in-process; unlabeled ones need one search per distinct artist.
+        target_genres = [g.lower() for g in genres]
+        unlabeled_artists = [songs[i]["artist"] for i in candidates if song_genres[i] is None]
+        searched_genres = await search_artists_genres(access_token, unlabeled_artists, debug) if unlabeled_artists else {}
+        for i in candidates:
+            joined = song_genres[i]
+            if joined is None:
+                matched = genres_overlap(target_genres, searched_genres[songs[i]["artist"]])
+            else:
+                matched = any(tg in joined for tg in target_genres)
+            if matched:
+                # Copy so the memoized preferences are never mutated by a request.
+                song = {**songs[i], "source": "personal", "reason": f"Matches genre constraint {genres}."}
+                filtered_songs.append(song)
+                if debug:
+                    reasoning.append(f"Song '{song['name']}' by {song['artist']} matches genre {genres}.")
         if debug:
             reasoning.append(f"After filtering, {len(filtered_songs)} personal songs remain.")
     else:
         if reference_track:
-            ref_details = get_reference_track_details(reference_track, debug)
+            # When the query names the artist, ask for similar tracks right away instead of waiting for
+            # the track search; the guess is only discarded if the search resolves to a different track.
+            track_guess, artist_guess = split_reference_track(reference_track)
+            similar_guess = None
+            if artist_guess:
+                ref_details, similar_guess = await asyncio.gather(
+                    fetch_reference_track_details(reference_track, debug),
+                    fetch_similar_tracks_lastfm(track_guess, artist_guess, limit=num_songs, debug=debug)
+                )
+            else:
+                ref_details = await fetch_reference_track_details(reference_track, debug)
             if ref_details is not None:
                 reference_track_name = ref_details.get("title")
                 reference_artist = ref_details.get("artist")
@@ -651,7 +1760,12 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
                 reference_artist = "Unknown"
                 if debug:
                     reasoning.append("Using provided reference track text; detailed info not found.")
-            external_recs = get_similar_tracks_lastfm(reference_track_name, reference_artist, limit=num_songs, debug=debug)
+            if similar_guess is not None and (str(reference_track_name).lower(), str(reference_artist).lower()) == (track_guess.lower(), artist_guess.lower()):
+                external_recs = similar_guess
+            else:
+                external_recs = await fetch_similar_tracks_lastfm(
+                    reference_track_name, reference_artist, limit=num_songs, debug=debug
+                )
             if external_recs:
                 for rec in external_recs:
                     rec["source"] = "Last.fm"
@@ -663,7 +1777,9 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
                 if debug:
                     reasoning.append("No recommendations from Last.fm; falling back on AI generation.")
         elif constraints.get("target_artist"):
-            external_recs = get_top_tracks_lastfm(constraints.get("target_artist"), limit=num_songs, debug=debug)
+            external_recs = await fetch_top_tracks_lastfm(
+                constraints.get("target_artist"), limit=num_songs, debug=debug
+            )
             if external_recs:
                 for rec in external_recs:
                     rec["source"] = "Last.fm"
@@ -671,67 +1787,11 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
                 filtered_songs += external_recs
                 if debug:
                     reasoning.append(f"Received {len(external_recs)} recommendations from Last.fm for artist {constraints.get('target_artist')}.")
-    if len(filtered_songs) < num_songs:
-        needed = num_songs - len(filtered_songs)
-        reference_line = ""
-        if reference_track:
-            reference_line = (f"Reference track: {reference_track}. Generate similar songs.")
-        instrument_line = ""
-        if constraints.get("instrument"):
-            instrument_line = f" Include songs with prominent {constraints.get('instrument')}."
-        prompt = f"""
-        Generate a playlist with the following constraints:
-        - Genre: {genres}
-        - BPM range: {bpm_start} to {bpm_end}
-        - Release years: {release_year_range[0]} to {release_year_range[1]}
-        - Mood constraints: {mood_constraints}
-        - Number of songs: {needed}
-        {reference_line}
-        {instrument_line}
-        
-        Respond in JSON format as a list of objects with keys "title", "artist", "bpm", and "release_year".
-        """
-        if debug:
-            reasoning.append("Prompting AI to generate additional songs with:")
-            reasoning.append(prompt)
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a music expert AI that generates playlists."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7
-            )
-            raw_content = response.choices[0].message.content
-            json_part = re.search(r"\[\s*{.*}\s*\]", raw_content, re.DOTALL)
-            if json_part:
-                ai_songs = json.loads(json_part.group(0))
-                for song in ai_songs:
-                    song["liked"] = False
-                    song["source"] = "AI"
-                    song["reason"] = "Generated by AI to meet remaining song count."
-                filtered_songs += ai_songs
-                if debug:
-                    reasoning.append(f"AI generated {len(ai_songs)} songs, added to playlist.")
-            else:
-                if debug:
-                    reasoning.append("AI response did not return valid JSON; no songs added.")
-        except Exception as e:
-            if debug:
-                reasoning.append(f"Error during AI generation: {str(e)}")
-    for song in filtered_songs:
-        if song.get("bpm", "Unknown") == "Unknown":
-            fallback_bpm = int((bpm_start + bpm_end) / 2)
-            song["bpm"] = fallback_bpm
-    if constraints.get("gradual_bpm"):
-        filtered_songs = sorted(filtered_songs, key=lambda s: s.get("bpm", int((bpm_start+bpm_end)/2)))
-        if debug:
-            reasoning.append("Sorted songs by BPM for gradual progression.")
-    
-    sp = spotipy.Spotify(auth=access_token)
-    enriched_songs = []
-    for song in filtered_songs[:num_songs]:
+    gradual_bpm = constraints.get("gradual_bpm")
+    fallback_bpm = int((bpm_start + bpm_end) / 2)
+
+    async def _enrich(song):
+        # Finds the song on Spotify for its cover and URI, swapping in an AI alternative when it has no cover.
         track_found = False
         candidate_song = song
         attempt_count = 0
@@ -739,10 +1799,10 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
             attempt_count += 1
             song_title = candidate_song.get("title") or candidate_song.get("name")
             query = f"track:{song_title} artist:{candidate_song['artist']}"
-            search_result = sp.search(q=query, type="track", limit=1)
+            search_result = await spotify_get(access_token, "search", {"q": query, "type": "track", "limit": 1})
             if not search_result["tracks"]["items"]:
                 fallback_query = f"{song_title} {candidate_song['artist']}"
-                search_result = sp.search(q=fallback_query, type="track", limit=1)
+                search_result = await spotify_get(access_token, "search", {"q": fallback_query, "type": "track", "limit": 1})
             if search_result["tracks"]["items"]:
                 track = search_result["tracks"]["items"][0]
                 if track["album"]["images"]:
@@ -754,24 +1814,25 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
                         reasoning.append(f"Song '{song_title}' by '{candidate_song['artist']}' has no album cover. Attempt {attempt_count}.")
                     alt_prompt = f"Generate a song suggestion with genre {genres}, BPM between {bpm_start} and {bpm_end}, release years between {release_year_range[0]} and {release_year_range[1]}, and mood constraints {mood_constraints}."
                     try:
-                        response = openai.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[
-                                {"role": "system", "content": "You are a music expert AI that generates song recommendations."},
-                                {"role": "user", "content": alt_prompt}
-                            ],
-                            temperature=0.7
-                        )
+                        async with _openai_semaphore:
+                            response = await get_openai_client().chat.completions.create(
+                                model="gpt-4o",
+                                messages=[
+                                    {"role": "system", "content": "You are a music expert AI that generates song recommendations."},
+                                    {"role": "user", "content": alt_prompt}
+                                ],
+                                temperature=0.7,
+                                max_tokens=song_tokens_budget(1),
+                                response_format=AI_SONGS_RESPONSE_FORMAT
+                            )
                         raw_content = response.choices[0].message.content
-                        json_part = re.search(r"\[\s*{.*}\s*\]", raw_content, re.DOTALL)
-                        if json_part:
-                            ai_songs = json.loads(json_part.group(0))
-                            if ai_songs:
-                                candidate_song = ai_songs[0]
-                                candidate_song["liked"] = False
-                                candidate_song["source"] = "AI"
-                                candidate_song["reason"] = "Alternative generated by AI due to missing album cover."
-                                continue
+                        ai_songs = orjson.loads(raw_content)["songs"] if raw_content else []
+                        if ai_songs:
+                            candidate_song = ai_songs[0]
+                            candidate_song["liked"] = False
+                            candidate_song["source"] = "AI"
+                            candidate_song["reason"] = "Alternative generated by AI due to missing album cover."
+                            continue
                     except Exception as e:
                         if debug:
                             reasoning.append(f"Error during alternative AI generation: {str(e)}")
@@ -782,20 +1843,110 @@ def generate_constrained_playlist(user_query, access_token=None, debug=False):
                 candidate_song["album_cover"] = "https://via.placeholder.com/200"
                 candidate_song["uri"] = None
                 track_found = True
-        enriched_songs.append(candidate_song)
-    
+        return candidate_song
+
+    # Songs are looked up concurrently (spotify_get paces the requests) but yielded in playlist order.
+    # Without a gradual progression the order is already final, so each lookup starts as soon as its
+    # song is known and overlaps the AI top-up; a gradual playlist has to be sorted first.
+    tasks = []
+    try:
+        if not gradual_bpm:
+            # Only a gradual progression picks from a wider pool; otherwise the extras are never used.
+            del filtered_songs[num_songs:]
+            tasks = [asyncio.ensure_future(_enrich(song)) for song in filtered_songs]
+        else:
+            # Bounded so a large liked library does not turn into hundreds of BPM lookups before the first entry.
+            del filtered_songs[GRADUAL_BPM_POOL_FACTOR * num_songs:]
+        if len(filtered_songs) < num_songs:
+            needed = num_songs - len(filtered_songs)
+            prompt = build_ai_playlist_prompt(
+                genres, bpm_start, bpm_end, release_year_range, mood_constraints, needed,
+                reference_track=reference_track, instrument=constraints.get("instrument")
+            )
+            if debug:
+                reasoning.append("Prompting AI to generate additional songs with:")
+                reasoning.append(prompt)
+            ai_song_count = 0
+            try:
+                async for song in iter_ai_songs(prompt, needed, refresh=refresh):
+                    song["liked"] = False
+                    song["source"] = "AI"
+                    # The model explains each pick in the same response; older cached answers have no reason.
+                    song["reason"] = song.get("reason") or "Generated by AI to meet remaining song count."
+                    filtered_songs.append(song)
+                    ai_song_count += 1
+                    if not gradual_bpm and len(tasks) < num_songs:
+                        tasks.append(asyncio.ensure_future(_enrich(song)))
+            except Exception as e:
+                if debug:
+                    reasoning.append(f"Error during AI generation: {str(e)}")
+            if debug:
+                if ai_song_count:
+                    reasoning.append(f"AI generated {ai_song_count} songs, added to playlist.")
+                else:
+                    reasoning.append("AI response was empty; no songs added.")
+        unknown_bpm = [song for song in filtered_songs if song.get("bpm", "Unknown") == "Unknown"]
+        if unknown_bpm and (gradual_bpm or constraints.get("concern_bpm")):
+            # BPM matters for this playlist, so look the missing ones up (concurrently) before falling back.
+            metadata = await get_song_metadata_batch(
+                [(song.get("title") or song.get("name"), song["artist"]) for song in unknown_bpm], debug
+            )
+            for song, song_metadata in zip(unknown_bpm, metadata):
+                if isinstance(song_metadata["bpm"], (int, float)):
+                    song["bpm"] = round(song_metadata["bpm"])
+            if debug:
+                reasoning.append(f"Looked up BPM for {len(unknown_bpm)} songs on AcousticBrainz.")
+        for song in unknown_bpm:
+            if song.get("bpm", "Unknown") == "Unknown":
+                song["bpm"] = fallback_bpm
+        if gradual_bpm:
+            # Every song has a numeric "bpm" by now, so the C-level itemgetter key can replace the lambda.
+            filtered_songs.sort(key=operator.itemgetter("bpm"))
+            if debug:
+                reasoning.append("Sorted songs by BPM for gradual progression.")
+            tasks = [asyncio.ensure_future(_enrich(song)) for song in filtered_songs[:num_songs]]
+
+        liked_index = load_liked_index(access_token)
+        for task in tasks:
+            candidate_song = await task
+            song_title = candidate_song.get("name") or candidate_song.get("title") or ""
+            if liked_key(song_title, candidate_song["artist"]) in liked_index:
+                candidate_song["liked"] = True
+            if ENABLE_COVER_PRELOAD and candidate_song.get("uri"):
+                preload_album_cover(candidate_song["album_cover"])
+            yield playlist_entry(candidate_song)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def generate_constrained_playlist(user_query, access_token=None, debug=False, refresh=False, explain=ENABLE_SONG_EXPLANATION):
+    """
+    Generates a playlist based on the user query and enriches each track with its album cover and track URI.
+    If a song cannot be found with an album cover, an alternative song is generated that fits the user query constraints.
+    With explain=True, each song also gets a model-written explanation (one extra call for the whole playlist).
+    """
+    if debug:
+        constraints, reasoning = await interpret_user_query(user_query, debug=debug)
+    else:
+        constraints = await interpret_user_query(user_query, debug=debug)
+        reasoning = None
+    constraints["user_query"] = user_query
     playlist = [
-        {"title": song.get("name", song.get("title")),
-         "artist": song["artist"],
-         "liked": song.get("liked", False),
-         "mood": song.get("mood", "Unknown"),
-         "source": song.get("source", "unknown"),
-         "reason": song.get("reason", "No reason provided"),
-         "bpm": song.get("bpm", "Unknown"),
-         "album_cover": song.get("album_cover"),
-         "uri": song.get("uri")}
-        for song in enriched_songs
+        entry async for entry in iter_constrained_playlist(constraints, access_token=access_token, reasoning=reasoning, refresh=refresh)
     ]
+    if explain:
+        try:
+            # AI picks already carry the model's reason, so only the other songs need explaining.
+            for song in playlist:
+                if song["source"] == "AI":
+                    song["explanation"] = song["reason"]
+            unexplained = [song for song in playlist if song["source"] != "AI"]
+            explanations = await explain_songs_batch(unexplained, constraints)
+            for song, explanation in zip(unexplained, explanations):
+                song["explanation"] = explanation
+        except Exception as e:
+            if debug:
+                reasoning.append(f"Error generating song explanations: {e}")
     if debug:
         validation_log = validate_playlist(playlist, constraints, debug=debug)
         reasoning.append("Final validation summary:")
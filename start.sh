@@ -1,3 +1,4 @@
 #!/bin/bash
-uvicorn main:app --host 0.0.0.0 --port 8000 &  # Start FastAPI in the background
+export WEB_CONCURRENCY="${WEB_CONCURRENCY:-$((2 * $(nproc)))}"  # Worker count; music_utils splits the Spotify rate across it
+gunicorn main:app -k uvicorn.workers.UvicornWorker -w "$WEB_CONCURRENCY" -b 0.0.0.0:8000 &  # Start FastAPI (uvloop + httptools workers) in the background
 streamlit run ui.py --server.port 8501 --server.address 0.0.0.0  # Start Streamlit